@@ -1,41 +1,380 @@
+import mmap
+import os
+import struct
 import cpu
 
+# External RAM size for each value of the header byte 0x149
+ram_sizes = [0, 0x800, 0x2000, 0x8000, 0x20000, 0x10000]
+
+# What 0xa000-0xbfff reads as while the cartridge RAM is disabled or missing
+open_bus = b"\xff" * 0x2000
+
+# T-states per second, used by the MBC3 real time clock
+clock_rate = 4194304
+
+# Cartridge types with a battery keeping the RAM alive
+battery_types = [0x03, 0x06, 0x09, 0x0d, 0x0f, 0x10, 0x13, 0x1b, 0x1e, 0xff]
+
+
+def open_save(path, size, fill):
+    # Map the save file as the cartridge RAM, stores go to the page cache and survive a crash
+    mode = 'r+b' if os.path.exists(path) else 'w+b'
+    with open(path, mode) as f:
+        length = os.fstat(f.fileno()).st_size
+        if length < size:
+            f.seek(length)
+            f.write(fill * (size - length))
+            f.flush()
+        return mmap.mmap(f.fileno(), size)
+
+
+class Header:
+    def __init__(self, rom):
+        if len(rom) < 0x150:
+            raise ValueError("ROM is too small to contain a cartridge header")
+        if rom[0x148] > 8:
+            raise ValueError("Unknown ROM size code " + hex(rom[0x148]))
+        if rom[0x149] >= len(ram_sizes):
+            raise ValueError("Unknown RAM size code " + hex(rom[0x149]))
+
+        self.title = bytes(rom[0x134:0x144]).split(b"\x00")[0].decode("ascii", "replace")
+        self.cartridge_type = rom[0x147]
+        self.battery = self.cartridge_type in battery_types
+        self.banks_num = 2 << rom[0x148]
+        self.rom_size = 0x4000 * self.banks_num
+        self.ram_size = ram_sizes[rom[0x149]]
+        self.header_checksum = rom[0x14d]
+        self.global_checksum = (rom[0x14e] << 8) | rom[0x14f]
+
+        checksum = 0
+        for byte in rom[0x134:0x14d]:
+            checksum = (checksum - byte - 1) & 255
+        self.header_checksum_ok = checksum == self.header_checksum
+        checksum = sum(rom) - rom[0x14e] - rom[0x14f]
+        self.global_checksum_ok = (checksum & 0xffff) == self.global_checksum
+
+
+class Mapper:
+    # ROM only cartridge, with optional RAM that is always enabled
+    rom_bank = 1
+    # Bank seen at 0x0000-0x3fff, only MBC1 in mode 1 changes it
+    rom0_bank = 0
+    ram_bank = 0
+    ram_enabled = True
+    # Writable view of the mapped RAM bank, None while it is disabled or not RAM
+    ram_view = None
+    # Bank currently copied into 0x4000-0x7fff, None when the bus has to be refreshed anyway
+    mapped_rom_bank = None
+
+    def __init__(self, cart, ram_size=None, ram_fill=b"\x00"):
+        self.rom = cart.rom
+        self.banks_num = cart.banks_num
+        if ram_size is None:
+            # 2 KiB RAM chips are given a whole 8 KiB bank so the mapped view is always complete
+            ram_size = max(cart.header.ram_size, 0x2000) if cart.header.ram_size != 0 else 0
+        if ram_size != 0 and cart.header.battery and cart.save_path is not None:
+            self.ram = open_save(cart.save_path, ram_size, ram_fill)
+        else:
+            self.ram = bytearray(ram_fill * ram_size)
+        self.ram_banks_num = max(len(self.ram) // 0x2000, 1)
+        # One handler per 8 KiB region of 0x0000-0x7fff, indexed by address >> 13
+        self.write_handlers = [self.write_nothing, self.write_nothing, self.write_nothing, self.write_nothing]
+
+    def write_nothing(self, key, value):
+        pass
+
+    # Banks are copied into the bus with a single slice assignment (about 1 us), so reads stay a plain index.
+    # Selecting the bank that is already mapped, as music drivers often do, copies nothing
+    def map_rom(self):
+        bank = self.rom_bank % self.banks_num
+        if bank == self.mapped_rom_bank:
+            return
+        self.mapped_rom_bank = bank
+        offset = 0x4000 * bank
+        cpu.memory.mem[0x4000:0x8000] = self.rom[offset:offset + 0x4000]
+
+    def map_rom0(self, bank):
+        self.rom0_bank = bank
+        offset = 0x4000 * (bank % self.banks_num)
+        cpu.memory.mem[0:0x4000] = self.rom[offset:offset + 0x4000]
+
+    def map_ram(self):
+        if not self.ram_enabled or len(self.ram) == 0:
+            self.ram_view = None
+            cpu.memory.mem[0xa000:0xc000] = open_bus
+            return
+        offset = 0x2000 * (self.ram_bank % self.ram_banks_num)
+        self.ram_view = memoryview(self.ram)[offset:offset + 0x2000]
+        cpu.memory.mem[0xa000:0xc000] = self.ram_view
+
+    def write_ram(self, key, value):
+        # Stores go to both the bus and the RAM (or its save file) so switching banks never copies back
+        if self.ram_view is not None:
+            self.ram_view[key - 0xa000] = value
+            cpu.memory.mem[key] = value
+
+    def write_ram_enable(self, key, value):
+        enabled = (value & 15) == 10
+        # Games disable the RAM once they are done saving, a good moment to write it back
+        if self.ram_enabled and not enabled:
+            self.flush()
+        self.ram_enabled = enabled
+        self.map_ram()
+
+    def flush(self):
+        if isinstance(self.ram, mmap.mmap):
+            self.ram.flush()
+
+    # Registers saved in a save state, followed by the whole RAM
+    state_fields = ["rom_bank", "rom0_bank", "ram_bank", "ram_enabled"]
+
+    def state_size(self) -> int:
+        return struct.calcsize("<" + "i" * len(self.state_fields)) + len(self.ram)
+
+    def save_state(self) -> bytes:
+        values = [int(getattr(self, name)) for name in self.state_fields]
+        return struct.pack("<" + "i" * len(values), *values) + bytes(self.ram)
+
+    def load_state(self, data):
+        state_format = "<" + "i" * len(self.state_fields)
+        for name, value in zip(self.state_fields, struct.unpack_from(state_format, data)):
+            setattr(self, name, value)
+        offset = struct.calcsize(state_format)
+        self.ram[:] = data[offset:offset + len(self.ram)]
+        self.mapped_rom_bank = None
+        self.map_rom0(self.rom0_bank)
+        self.map_rom()
+        self.map_ram()
+
+
+class MBC1(Mapper):
+    ram_enabled = False
+    bank1 = 1
+    bank2 = 0
+    mode = 0
+    state_fields = Mapper.state_fields + ["bank1", "bank2", "mode"]
+
+    def __init__(self, cart):
+        super().__init__(cart)
+        self.write_handlers = [self.write_ram_enable, self.write_bank1, self.write_bank2, self.write_mode]
+
+    def update_banks(self):
+        self.rom_bank = (self.bank2 << 5) | self.bank1
+        self.map_rom()
+        if self.mode == 1:
+            self.ram_bank = self.bank2
+            if self.banks_num > 32:
+                self.map_rom0(self.bank2 << 5)
+        else:
+            self.ram_bank = 0
+            if self.banks_num > 32:
+                self.map_rom0(0)
+        self.map_ram()
+
+    def write_bank1(self, key, value):
+        self.bank1 = (value & 31) or 1
+        self.update_banks()
+
+    def write_bank2(self, key, value):
+        self.bank2 = value & 3
+        self.update_banks()
+
+    def write_mode(self, key, value):
+        self.mode = value & 1
+        self.update_banks()
+
+
+class MBC2(Mapper):
+    ram_enabled = False
+
+    def __init__(self, cart):
+        # 512 half-byte cells mirrored over the whole 0xa000-0xbfff range
+        super().__init__(cart, 0x2000, b"\xff")
+        self.write_handlers = [self.write_register, self.write_register, self.write_nothing, self.write_nothing]
+
+    def write_register(self, key, value):
+        if key & 0x100 == 0:
+            self.write_ram_enable(key, value)
+        else:
+            self.rom_bank = (value & 15) or 1
+            self.map_rom()
+
+    def write_ram(self, key, value):
+        if self.ram_enabled:
+            value |= 0xf0
+            mem = cpu.memory.mem
+            for i in range(key & 0x1ff, 0x2000, 0x200):
+                self.ram[i] = value
+                mem[0xa000 + i] = value
+
+
+class RTC:
+    # Time is kept as a number of seconds counted from the emulated clock
+    state_format = "<qqBB5B"
+    seconds_base = 0
+    t_states_base = 0
+    halted = False
+    day_carry = 0
+
+    def __init__(self):
+        self.latched = [0, 0, 0, 0, 0]
+
+    def seconds(self) -> int:
+        if self.halted:
+            return self.seconds_base
+        return self.seconds_base + (cpu.clock.t_states - self.t_states_base) // clock_rate
+
+    def set_seconds(self, seconds):
+        self.seconds_base = seconds
+        self.t_states_base = cpu.clock.t_states
+
+    def latch(self):
+        seconds = self.seconds()
+        days = seconds // 86400
+        if days > 511:
+            self.day_carry = 1
+            days &= 511
+            self.set_seconds(seconds % 86400 + days * 86400)
+        self.latched = [seconds % 60, (seconds // 60) % 60, (seconds // 3600) % 24, days & 255,
+                        (days >> 8) | (self.halted << 6) | (self.day_carry << 7)]
+
+    def write(self, register, value):
+        seconds = self.seconds()
+        fields = [seconds % 60, (seconds // 60) % 60, (seconds // 3600) % 24, (seconds // 86400) & 511]
+        if register == 4:
+            fields[3] = (fields[3] & 255) | ((value & 1) << 8)
+            self.halted = value & 64 != 0
+            self.day_carry = value >> 7
+        elif register == 3:
+            fields[3] = (fields[3] & 256) | value
+        else:
+            fields[register] = value
+        self.set_seconds(fields[0] + fields[1] * 60 + fields[2] * 3600 + fields[3] * 86400)
+        self.latched[register] = value
+
+    def save_state(self) -> bytes:
+        return struct.pack(self.state_format, self.seconds_base, self.t_states_base, self.halted, self.day_carry, *self.latched)
+
+    def load_state(self, data):
+        values = struct.unpack_from(self.state_format, data)
+        self.seconds_base, self.t_states_base, self.halted, self.day_carry = values[0:4]
+        self.halted = self.halted != 0
+        self.latched = list(values[4:9])
+
+
+class MBC3(Mapper):
+    ram_enabled = False
+    latch_value = 0xff
+    state_fields = Mapper.state_fields + ["latch_value"]
+
+    def __init__(self, cart):
+        super().__init__(cart)
+        self.rtc = RTC()
+        self.write_handlers = [self.write_ram_enable, self.write_rom_bank, self.write_ram_bank, self.write_latch]
+
+    def map_ram(self):
+        if self.ram_enabled and self.ram_bank >= 8:
+            # RTC registers read the same value over the whole range
+            self.ram_view = None
+            cpu.memory.mem[0xa000:0xc000] = bytes([self.rtc.latched[self.ram_bank - 8]]) * 0x2000
+        else:
+            super().map_ram()
+
+    def write_ram(self, key, value):
+        if self.ram_bank >= 8:
+            if self.ram_enabled:
+                self.rtc.write(self.ram_bank - 8, value)
+                self.map_ram()
+        else:
+            super().write_ram(key, value)
+
+    def write_rom_bank(self, key, value):
+        self.rom_bank = (value & 127) or 1
+        self.map_rom()
+
+    def write_ram_bank(self, key, value):
+        if value <= 3 or 8 <= value <= 12:
+            self.ram_bank = value
+            self.map_ram()
+
+    def write_latch(self, key, value):
+        if self.latch_value == 0 and value == 1:
+            self.rtc.latch()
+            self.map_ram()
+        self.latch_value = value
+
+    def state_size(self) -> int:
+        return struct.calcsize(RTC.state_format) + super().state_size()
+
+    def save_state(self) -> bytes:
+        return self.rtc.save_state() + super().save_state()
+
+    def load_state(self, data):
+        # The clock goes first, map_ram shows the latched registers
+        self.rtc.load_state(data)
+        super().load_state(data[struct.calcsize(RTC.state_format):])
+
+
+class MBC5(Mapper):
+    ram_enabled = False
+
+    def __init__(self, cart):
+        super().__init__(cart)
+        self.write_handlers = [self.write_ram_enable, self.write_rom_bank, self.write_ram_bank, self.write_nothing]
+
+    def write_rom_bank(self, key, value):
+        if key & 0x1000 == 0:
+            self.rom_bank = (self.rom_bank & 256) | value
+        else:
+            self.rom_bank = (self.rom_bank & 255) | ((value & 1) << 8)
+        self.map_rom()
+
+    def write_ram_bank(self, key, value):
+        self.ram_bank = value & 15
+        self.map_ram()
+
+
+# Mapper used for each cartridge type (header byte 0x147)
+mapper_types = {
+    0x01: MBC1, 0x02: MBC1, 0x03: MBC1,
+    0x05: MBC2, 0x06: MBC2,
+    0x0f: MBC3, 0x10: MBC3, 0x11: MBC3, 0x12: MBC3, 0x13: MBC3,
+    0x19: MBC5, 0x1a: MBC5, 0x1b: MBC5, 0x1c: MBC5, 0x1d: MBC5, 0x1e: MBC5,
+}
+
+
 class Cartridge:
     romtype = 0
     romsize = 0
-    is_switched_rom = False
-    rom = []
-    bank = 1
     banks_num = 0
 
-    def __init__(self, romfile):
+    def __init__(self, romfile, save_ram=True):
         self.romfile = romfile
+        # Battery backed RAM lives in <rom>.sav next to the ROM
+        self.save_path = os.path.splitext(romfile)[0] + ".sav" if save_ram else None
+        # The whole file is mapped at once, bank switching copies a 16 KiB slice of it into the bus
         with open(self.romfile, 'rb') as f:
-            f.seek(0x147, 1)
-            self.romtype = int.from_bytes(f.read(1))
-            self.banks_num = 2 * (1 << int.from_bytes(f.read(1)))
-            self.romsize = (2**14) * self.banks_num
+            if os.fstat(f.fileno()).st_size == 0:
+                raise ValueError(romfile + " is empty")
+            self.rom = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
 
-        with open(self.romfile, 'rb') as f:
-            for i in range(self.romsize):
-                bytes = f.read(1)
-                self.rom.append(int.from_bytes(bytes))
+        self.header = Header(self.rom)
+        if len(self.rom) < self.header.rom_size:
+            raise ValueError(romfile + " is " + str(len(self.rom)) + " bytes but its header declares " + str(self.header.rom_size))
+        self.romtype = self.header.cartridge_type
+        self.romsize = self.header.rom_size
+        self.banks_num = self.header.banks_num
+        self.mapper = mapper_types.get(self.romtype, Mapper)(self)
 
     def load_rom(self):
-        for i in range(0x8000):
-            cpu.memory.mem[i] = self.rom[i]
+        # Bank 0 is fixed in memory, the mapper copies in the switchable bank and RAM
+        cpu.memory.mem[0:0x4000] = self.rom[0:0x4000]
+        cpu.memory.attach_mapper(self.mapper)
+        self.mapper.mapped_rom_bank = None
+        self.mapper.map_rom()
+        self.mapper.map_ram()
 
-    def load_rom_old(self):
-        with open(self.romfile, 'rb') as f:
-            for i in range(2**15):
-                bytes = f.read(1)
-                cpu.memory.mem[i] = (int.from_bytes(bytes))
-
-    def switch_bank(self):
-        self.is_switched_rom = False
-        if self.bank == 0:
-            self.bank = 1
-        for i in range(0x4000):
-            cpu.memory.mem[i + 0x4000] = self.rom[i + 0x4000 * self.bank]
-
-game = None
\ No newline at end of file
+    def flush(self):
+        self.mapper.flush()
+
+game = None
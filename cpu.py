@@ -1,75 +1,128 @@
+import heapq
+from functools import partial
 import debugcpu
 import prettyhex
-import cartridge
 
 class Registers:
-    r = {
-        "a": 0x01,
-        "b": 0,
-        "c": 0x13,
-        "d": 0,
-        "e": 0xd8,
-        "h": 0x01,
-        "l": 0x4d,
-        "sp": 0xfffe
-    }
-    pc = 0x0100
-
-    flagZ = 1
-    flagN = 0
-    flagH = 1
-    flagC = 1
-
-    ime_to_be_setted = 0
-    ime = 0
-
-    dma_transfer = False
+    __slots__ = ("a", "b", "c", "d", "e", "h", "l", "sp", "pc", "flagZ", "flagN", "flagH", "flagC",
+                 "lazy_flags", "ime_to_be_setted", "ime", "dma_transfer", "halted", "stopped", "halt_bug")
 
+    def __init__(self):
+        self.a = 0x01
+        self.b = 0
+        self.c = 0x13
+        self.d = 0
+        self.e = 0xd8
+        self.h = 0x01
+        self.l = 0x4d
+        self.sp = 0xfffe
+        self.pc = 0x0100
+
+        self.flagZ = 1
+        self.flagN = 0
+        self.flagH = 1
+        self.flagC = 1
+        # Operands of the last add, sub or inc/dec as (a, value, raw result, N, keeps C),
+        # the flag slots are stale while it is set and only brought up to date when read
+        self.lazy_flags = None
+
+        self.ime_to_be_setted = 0
+        self.ime = 0
+
+        # True while an OAM DMA keeps the CPU off the bus
+        self.dma_transfer = False
+
+        # Set by HALT and STOP until an interrupt (or a button press for STOP) wakes the CPU
+        self.halted = False
+        self.stopped = False
+        # Set by a HALT that did not halt, the next instruction runs without moving PC past its opcode
+        self.halt_bug = False
+
+    def sync_flags(self):
+        a, value, raw, n, keep_carry = self.lazy_flags
+        self.lazy_flags = None
+        self.flagZ = 0 if raw & 255 else 1
+        self.flagN = n
+        # Bit 4 of a ^ value ^ result is the carry (or borrow) out of the low nibble
+        self.flagH = ((a ^ value ^ raw) >> 4) & 1
+        if not keep_carry:
+            self.flagC = (raw >> 8) & 1
+
+    def sync_carry(self):
+        # For instructions that set every flag but C, the rest of the pending result is dropped
+        lazy = self.lazy_flags
+        self.lazy_flags = None
+        if not lazy[4]:
+            self.flagC = (lazy[2] >> 8) & 1
+
+    @property
+    def f(self):
+        if self.lazy_flags is not None:
+            self.sync_flags()
+        return (self.flagZ << 7) | (self.flagN << 6) | (self.flagH << 5) | (self.flagC << 4)
+
+    @f.setter
+    def f(self, value):
+        self.lazy_flags = None
+        self.flagZ = value >> 7
+        self.flagN = (value >> 6) & 1
+        self.flagH = (value >> 5) & 1
+        self.flagC = (value >> 4) & 1
+
+    @property
+    def af(self):
+        return (self.a << 8) | self.f
+
+    @af.setter
+    def af(self, value):
+        self.a = value >> 8
+        self.f = value & 255
+
+    @property
+    def bc(self):
+        return (self.b << 8) | self.c
+
+    @bc.setter
+    def bc(self, value):
+        self.b = value >> 8
+        self.c = value & 255
+
+    @property
+    def de(self):
+        return (self.d << 8) | self.e
+
+    @de.setter
+    def de(self, value):
+        self.d = value >> 8
+        self.e = value & 255
+
+    @property
+    def hl(self):
+        return (self.h << 8) | self.l
+
+    @hl.setter
+    def hl(self, value):
+        self.h = value >> 8
+        self.l = value & 255
+
+    # String keys are kept for tests.py and the debug tools
     def __getitem__(self, key):
-        if key == "f":
-            return (self.flagZ << 7) + (self.flagN << 6) + (self.flagH << 5) + (self.flagC << 4)
-        elif key == "af":
-            return (self.r["a"] << 8) + self["f"]
-        elif key == "bc":
-            return (self.r["b"] << 8) + self.r["c"]
-        elif key == "de":
-            return (self.r["d"] << 8) + self.r["e"]
-        elif key == "hl":
-            return (self.r["h"] << 8) + self.r["l"]
-        elif key == "[hl]":
-            return memory[self["hl"]]
-        else:
-            return self.r[key]
+        if key == "[hl]":
+            return memory[self.hl]
+        return getattr(self, key)
 
     def __setitem__(self, key, value):
-        if key == "af":
-            self.r["a"] = value >> 8
-            self["f"] = value & 255
-        elif key == "bc":
-            self.r["b"] = value >> 8
-            self.r["c"] = value & 255
-        elif key == "de":
-            self.r["d"] = value >> 8
-            self.r["e"] = value & 255
-        elif key == "hl":
-            self.r["h"] = value >> 8
-            self.r["l"] = value & 255
-        elif key == "[hl]":
-            memory[self["hl"]] = value
-        elif key == "f":
-            self.flagZ = value >> 7
-            self.flagN = (value >> 6) & 1
-            self.flagH = (value >> 5) & 1
-            self.flagC = (value >> 4) & 1
+        if key == "[hl]":
+            memory[self.hl] = value
         else:
-            self.r[key] = value
+            setattr(self, key, value)
 
     def __repr__(self):
-        rstring = "AF  = $" + prettyhex.prettyhex2(self["a"]) + prettyhex.prettyhex2(self["f"])
-        rstring += "\nBC  = $" + prettyhex.prettyhex2(self["b"]) + prettyhex.prettyhex2(self["c"])
-        rstring += "\nDE  = $" + prettyhex.prettyhex2(self["d"]) + prettyhex.prettyhex2(self["e"])
-        rstring += "\nHL  = $" + prettyhex.prettyhex2(self["h"]) + prettyhex.prettyhex2(self["l"])
-        rstring += "\nSP  = $" + prettyhex.prettyhex(self["sp"])
+        rstring = "AF  = $" + prettyhex.prettyhex2(self.a) + prettyhex.prettyhex2(self.f)
+        rstring += "\nBC  = $" + prettyhex.prettyhex2(self.b) + prettyhex.prettyhex2(self.c)
+        rstring += "\nDE  = $" + prettyhex.prettyhex2(self.d) + prettyhex.prettyhex2(self.e)
+        rstring += "\nHL  = $" + prettyhex.prettyhex2(self.h) + prettyhex.prettyhex2(self.l)
+        rstring += "\nSP  = $" + prettyhex.prettyhex(self.sp)
         rstring += "\nPC  = $" + prettyhex.prettyhex(self.pc)
         if self.ime == 1:
             rstring += "\nIME = Enabled\n"
@@ -78,89 +131,351 @@ class Registers:
         return rstring
 
     def debug_compare(self):
-        return [self["af"], self["bc"], self["de"], self["hl"], self["sp"], self.pc]
+        return [self.af, self.bc, self.de, self.hl, self.sp, self.pc]
 
 class Memory:
-    mem = [0 for _ in range(2**16)]
-
     def __init__(self):
+        self.mem = bytearray(0x10000)
         for i in range(0xfea0, 0xff00):
             self.mem[i] = 255
 
+        # One flag per tile in 0x8000-0x97ff, cleared by the PPU once it decoded the tile
+        self.dirty_tiles = bytearray(b"\x01" * 384)
+        self.vram_dirty = True
+        # Bumped on every write to the tile map at 0x9800 and 0x9c00 respectively
+        self.tile_map_versions = [0, 0]
+        self.oam_dirty = True
+        # Bus contents hidden while an OAM DMA runs, with the write handlers they had
+        self.dma_saved = None
+        self.dma_write_page = None
+        # IE & IF, kept up to date by every write to either so the CPU tests a single value
+        self.pending = 0
+        # Cartridge mapper handling writes to 0x0000-0x7fff and 0xa000-0xbfff
+        self.mapper = None
+
+        # Write handler for each 256 byte page, indexed by address >> 8
+        self.write_page = [self.write_plain for _ in range(256)]
+        for page in range(0x00, 0x80):
+            self.write_page[page] = self.write_nothing
+        for page in range(0x80, 0x98):
+            self.write_page[page] = self.write_tile
+        for page in range(0x98, 0xa0):
+            self.write_page[page] = self.write_tile_map
+        for page in range(0xa0, 0xc0):
+            self.write_page[page] = self.write_nothing
+        for page in range(0xc0, 0xde):
+            self.write_page[page] = self.write_wram
+        for page in range(0xe0, 0xfe):
+            self.write_page[page] = self.write_echo
+        self.write_page[0xfe] = self.write_oam
+        self.write_page[0xff] = self.write_io
+
+        # IO registers (and HRAM) with side effects, None is a plain store
+        self.io_handlers = [None for _ in range(256)]
+        self.io_handlers[0x41] = self.write_stat
+        self.io_handlers[0x46] = self.write_dma
+        self.io_handlers[0x02] = self.write_sc
+        self.io_handlers[0x04] = self.write_div
+        self.io_handlers[0x05] = self.write_tima
+        self.io_handlers[0x07] = self.write_tac
+        self.io_handlers[0x0f] = self.write_interrupts
+        self.io_handlers[0xff] = self.write_interrupts
+
+    def attach_mapper(self, mapper):
+        self.mapper = mapper
+        for page in range(0x00, 0x80):
+            self.write_page[page] = mapper.write_handlers[page >> 5]
+        for page in range(0xa0, 0xc0):
+            self.write_page[page] = mapper.write_ram
+
     def __getitem__(self, key):
+        if key >= 0xff00:
+            return self.read_io(key)
+        return self.mem[key]
+
+    def read_io(self, key):
+        # DIV and TIMA are derived from the clock, they are only updated when read
+        if key == 0xff04 or key == 0xff05:
+            timer.sync()
         return self.mem[key]
 
     def __setitem__(self, key, value):
-        if (0x0000 <= key <= 0x7fff) or (0xfea0 <= key <= 0xfeff):
-            if cartridge.game.romtype == 1:
-                if 0x2000 <= key <= 0x3fff:
-                    cartridge.game.bank = value & 31
-                    cartridge.game.is_switched_rom = True
-            else:
-                pass
-        elif 0xe000 <= key <= 0xfdff:
-            self.mem[key] = value
-            self.mem[key - 0x2000] = value
-        elif 0xc000 <= key <= 0xddff:
+        self.write_page[key >> 8](key, value)
+
+    def write_plain(self, key, value):
+        self.mem[key] = value
+
+    def write_nothing(self, key, value):
+        pass
+
+    def write_tile(self, key, value):
+        self.mem[key] = value
+        self.dirty_tiles[(key - 0x8000) >> 4] = 1
+        self.vram_dirty = True
+
+    def write_tile_map(self, key, value):
+        self.mem[key] = value
+        self.tile_map_versions[(key >> 10) & 1] += 1
+
+    def write_wram(self, key, value):
+        self.mem[key] = value
+        self.mem[key + 0x2000] = value
+
+    def write_echo(self, key, value):
+        self.mem[key] = value
+        self.mem[key - 0x2000] = value
+
+    def write_oam(self, key, value):
+        if key < 0xfea0:
             self.mem[key] = value
-            self.mem[key + 0x2000] = value
-        elif key == 0xff46:
+            self.oam_dirty = True
+
+    def write_io(self, key, value):
+        handler = self.io_handlers[key & 0xff]
+        if handler is None:
             self.mem[key] = value
-            registers.dma_transfer = True
         else:
-            self.mem[key] = value
+            handler(key, value)
+
+    def write_stat(self, key, value):
+        # The mode and LYC coincidence bits are read only
+        self.mem[key] = 0x80 | (value & 0x78) | (self.mem[key] & 7)
+
+    def write_interrupts(self, key, value):
+        self.mem[key] = value
+        self.pending = self.mem[0xffff] & self.mem[0xff0f] & 31
+
+    def write_dma(self, key, value):
+        self.mem[key] = value
+        if registers.dma_transfer:
+            clock.cancel(dma_event)
+            self.end_dma(clock.t_states)
+        source = value << 8
+        if source >= 0xe000:
+            # 0xe000-0xffff reads the work RAM behind the echo
+            source -= 0x2000
+        self.mem[0xfe00:0xfea0] = self.mem[source:source + 160]
+        self.oam_dirty = True
+        self.block_bus(clock.t_states + 640)
+
+    def block_bus(self, deadline):
+        # For the 160 M-cycles of the transfer the CPU only reaches VRAM, IO and HRAM,
+        # the rest of the bus reads 0xff and ignores writes until end_dma puts it back
+        registers.dma_transfer = True
+        self.dma_saved = (bytes(self.mem[0x0000:0x8000]), bytes(self.mem[0xa000:0xfea0]))
+        self.dma_write_page = self.write_page[:]
+        self.mem[0x0000:0x8000] = b"\xff" * 0x8000
+        self.mem[0xa000:0xfea0] = b"\xff" * 0x5ea0
+        self.write_page[0x00:0x80] = [self.write_nothing] * 0x80
+        self.write_page[0xa0:0xff] = [self.write_nothing] * 0x5f
+        clock.schedule(deadline, dma_event, self.end_dma)
+
+    def end_dma(self, deadline):
+        low, high = self.dma_saved
+        self.mem[0x0000:0x8000] = low
+        self.mem[0xa000:0xfea0] = high
+        self.write_page[:] = self.dma_write_page
+        self.dma_saved = None
+        # The PPU may have cached the blocked OAM in the meantime
+        self.oam_dirty = True
+        registers.dma_transfer = False
+
+    def write_sc(self, key, value):
+        self.mem[key] = value
+        if value & 0x81 == 0x81:
+            clock.start_serial()
+
+    def write_div(self, key, value):
+        timer.reset_div()
+
+    def write_tima(self, key, value):
+        timer.write_tima(value)
+
+    def write_tac(self, key, value):
+        timer.write_tac(value)
 
 class Tick:
     t_states = 0
-    scan_line_tick = 188
-    tima_counter = 0
-    divider_register = 0
+    frames = 0
 
-    def add_tick(self, n):
-        self.t_states += n
+    # PPU mode (0 HBlank, 1 VBlank, 2 OAM scan, 3 drawing)
+    mode = 1
+    # Object with render_line(ly) and end_frame(), set by ppu.Renderer
+    renderer = None
+
+    def __init__(self):
+        # Pending events as (T-state deadline, kind, callback), the kind orders events due at the same time
+        self.events = []
+        # Deadline of the earliest event, add_tick does nothing else until it is reached
+        self.next_event = 0
+        # Emulation starts 188 T-states into a VBlank line
+        self.schedule(268, ppu_event, self.next_mode)
+
+    def schedule(self, deadline, kind, callback):
+        heapq.heappush(self.events, (deadline, kind, callback))
+        self.next_event = self.events[0][0]
+
+    def cancel(self, kind):
+        # In place, run_events may be iterating over the list when a callback cancels an event
+        self.events[:] = [event for event in self.events if event[1] != kind]
+        heapq.heapify(self.events)
+        self.next_event = self.events[0][0] if self.events else float("inf")
+
+    def run_events(self):
+        events = self.events
+        while events and events[0][0] <= self.t_states:
+            deadline, kind, callback = heapq.heappop(events)
+            callback(deadline)
+        self.next_event = events[0][0] if events else float("inf")
+
+    def set_mode(self, mode):
+        self.mode = mode
+        memory.mem[0xff41] = (memory.mem[0xff41] & 0xfc) | mode
+
+    def next_mode(self, deadline):
+        # Each mode schedules the next one relative to its own deadline, so late events do not drift
+        stat = memory[0xff41]
+        if self.mode == 2:
+            self.set_mode(3)
+            self.schedule(deadline + 172, ppu_event, self.next_mode)
+        elif self.mode == 3:
+            self.set_mode(0)
+            self.schedule(deadline + 204, ppu_event, self.next_mode)
+            if self.renderer is not None:
+                self.renderer.render_line(memory[0xff44])
+            if stat & 8 != 0:
+                memory[0xff0f] |= 2
+        else:
+            ly = memory[0xff44] + 1
+            if ly == 154:
+                ly = 0
+            memory.mem[0xff44] = ly
+
+            if ly == memory[0xff45]:
+                memory.mem[0xff41] |= 4
+                if stat & 64 != 0:
+                    memory[0xff0f] |= 2
+            else:
+                memory.mem[0xff41] &= 0xfb
 
-        self.scan_line_tick += n
-        if self.scan_line_tick >= 456:
-            self.scan_line_tick -= 456
-            memory[0xff44] += 1
-            if memory[0xff44] == memory[0xff45]:
-                memory[0xff41] |= 2
-                if memory[0xff41] & 64 != 0:
+            if ly < 144:
+                self.set_mode(2)
+                self.schedule(deadline + 80, ppu_event, self.next_mode)
+                if stat & 32 != 0:
                     memory[0xff0f] |= 2
             else:
-                memory[0xff41] &= 253
-            if memory[0xff44] == 144:
-                memory[0xff0f] |= 1
-            if memory[0xff44] >= 153:
-                self.scan_line_tick -= 456
-                memory[0xff44] = 0
-
-        if memory[0xff07] & 1 == 1:
-            self.tima_counter += n
-            if self.tima_counter > clock_select[memory[0xff07] & 3]:
-                self.tima_counter = 0
-                memory[0xff05] += 1
-                if memory[0xff05] == 256:
-                    memory[0xff05] = memory[0xff06]
-                    memory[0xff0f] |= 4
-
-        self.divider_register += n
-        if self.divider_register >= 16384:
-            self.divider_register -= 16384
-            memory[0xff04] += 1
-            memory[0xff04] &= 255
+                self.schedule(deadline + 456, ppu_event, self.next_mode)
+                if ly == 144:
+                    self.set_mode(1)
+                    memory[0xff0f] |= 1
+                    if stat & 16 != 0:
+                        memory[0xff0f] |= 2
+                    self.frames += 1
+                    if self.renderer is not None:
+                        self.renderer.end_frame()
+
+    def start_serial(self):
+        # Nothing is ever connected, a transfer on the internal clock shifts in 0xff after 8 bits at 8192 Hz
+        self.cancel(serial_event)
+        self.schedule(self.t_states + 4096, serial_event, self.serial_done)
+
+    def serial_done(self, deadline):
+        memory.mem[0xff01] = 0xff
+        memory.mem[0xff02] &= 0x7f
+        memory[0xff0f] |= 8
+
+    def cycles_to_next_event(self):
+        # T-states until the next event, in whole M-cycles.
+        # The PPU keeps running during STOP, so the host still gets frames to poll the joypad
+        return max((self.next_event - self.t_states + 3) & ~3, 4)
+
+    def add_tick(self, n):
+        self.t_states += n
+        if self.t_states >= self.next_event:
+            self.run_events()
+
+class Timer:
+    # DIV is the top byte of a 16 bit counter running since div_base, TIMA counts its falling edges
+    # at bit (period / 2) while TAC bit 2 is set. Nothing is stepped, values are derived from the clock
+    div_base = 0
+    # TIMA value when the counter was at tima_sync
+    tima_value = 0
+    tima_sync = 0
+
+    def counter(self) -> int:
+        return clock.t_states - self.div_base
+
+    def sync(self):
+        counter = self.counter()
+        memory.mem[0xff04] = (counter >> 8) & 255
+        tac = memory.mem[0xff07]
+        if tac & 4 != 0:
+            period = clock_select[tac & 3]
+            # Overflows are scheduled events, so TIMA never runs past 255 here
+            self.tima_value += counter // period - self.tima_sync // period
+        self.tima_sync = counter
+        memory.mem[0xff05] = self.tima_value
+
+    def schedule_overflow(self):
+        clock.cancel(timer_event)
+        tac = memory.mem[0xff07]
+        if tac & 4 != 0:
+            period = clock_select[tac & 3]
+            overflow = (self.tima_sync // period + 256 - self.tima_value) * period
+            clock.schedule(self.div_base + overflow, timer_event, self.overflow)
+
+    def overflow(self, deadline):
+        # TIMA is reloaded from TMA at the exact T-state it overflowed, even if the event runs late
+        self.tima_value = memory.mem[0xff06]
+        self.tima_sync = deadline - self.div_base
+        memory.mem[0xff05] = self.tima_value
+        memory[0xff0f] |= 4
+        self.schedule_overflow()
+
+    def falling_edge(self):
+        # The timer input falls when DIV or TAC writes clear it, which counts as an increment
+        if self.tima_value == 255:
+            self.tima_value = memory.mem[0xff06]
+            memory[0xff0f] |= 4
+        else:
+            self.tima_value += 1
+        memory.mem[0xff05] = self.tima_value
+
+    def timer_input(self, tac: int) -> bool:
+        return tac & 4 != 0 and self.counter() & (clock_select[tac & 3] >> 1) != 0
+
+    def reset_div(self):
+        self.sync()
+        if self.timer_input(memory.mem[0xff07]):
+            self.falling_edge()
+        self.div_base = clock.t_states
+        self.tima_sync = 0
+        memory.mem[0xff04] = 0
+        self.schedule_overflow()
+
+    def write_tima(self, value):
+        self.sync()
+        self.tima_value = value
+        memory.mem[0xff05] = value
+        self.schedule_overflow()
+
+    def write_tac(self, value):
+        self.sync()
+        old_input = self.timer_input(memory.mem[0xff07])
+        memory.mem[0xff07] = value
+        if old_input and not self.timer_input(value):
+            self.falling_edge()
+        self.schedule_overflow()
 
 registers = Registers()
 
-# Set this variable to True for running the tests
+# Flat memory without cartridge or IO behaviour, tests.py switches to it by itself
 debug = False
 if debug:
     memory = debugcpu.Memory()
 else:
     memory = Memory()
 
-clock = Tick()
-
 r8 = ["b", "c", "d", "e", "h", "l", "[hl]", "a"]
 r16 = ["bc", "de", "hl", "sp"]
 r16stk = ["bc", "de", "hl", "af"]
@@ -170,933 +485,1094 @@ rst_vec = [0x00, 0x08, 0x10, 0x18, 0x20, 0x28, 0x30, 0x38]
 
 clock_select = [1024, 16, 64, 256]
 
-opcode = 0
-imm8 = 0
-imm16 = 0
-condition = ""
-dest_source_r16mem = ""
-operand_r8 = ""
-operand_r16 = ""
-operand_stk_r8 = ""
-operand_stk_r16 = ""
-b3 = 0
-tgt3 = 0
-
-
-def is_carry(val1, val2, bits, subtraction):
-    carry_size = (2 ** bits) - 1
-    if subtraction:
-        if ((val1 & carry_size) - (val2 & carry_size)) < 0:
-            return 1
-        return 0
+# Kinds of the events scheduled on the clock
+ppu_event = 0
+timer_event = 1
+serial_event = 2
+dma_event = 3
+
+clock = Tick()
+timer = Timer()
+
+
+def reset():
+    # Power-on state for the next ROM. The objects are kept, the handler tables are bound to them
+    registers.__init__()
+    memory.__init__()
+    vars(clock).clear()
+    clock.__init__()
+    vars(timer).clear()
+
+
+def read(addr):
+    # Some IO registers are only brought up to date when read, the rest of the bus is read directly
+    if addr >= 0xff00:
+        return memory.read_io(addr)
+    return memory.mem[addr]
+
+
+def read_hl():
+    addr = (registers.h << 8) | registers.l
+    if addr >= 0xff00:
+        return memory.read_io(addr)
+    return memory.mem[addr]
+
+
+def write_hl(value):
+    memory[(registers.h << 8) | registers.l] = value
+
+
+# Operand accessors following the opcode encoding, bound once so handlers never decode indices
+r8_getters = [read_hl if name == "[hl]" else partial(getattr, registers, name) for name in r8]
+r8_setters = [write_hl if name == "[hl]" else partial(setattr, registers, name) for name in r8]
+r16_getters = [partial(getattr, registers, name) for name in r16]
+r16_setters = [partial(setattr, registers, name) for name in r16]
+r16stk_getters = [partial(getattr, registers, name) for name in r16stk]
+r16stk_setters = [partial(setattr, registers, name) for name in r16stk]
+
+
+def flag_z():
+    # Jumps read Z and C straight from a pending result instead of syncing every flag
+    lazy = registers.lazy_flags
+    if lazy is None:
+        return registers.flagZ
+    return 0 if lazy[2] & 255 else 1
+
+
+def flag_c():
+    lazy = registers.lazy_flags
+    if lazy is None or lazy[4]:
+        return registers.flagC
+    return (lazy[2] >> 8) & 1
+
+
+# nz and z test Z, nc and c test C, the condition holds when the flag equals condition & 1
+condition_flags = [flag_z, flag_z, flag_c, flag_c]
+
+
+def shift_table(operation):
+    # Result, Z and C for every value | C << 8, so a rotate or shift gets everything it sets from one index
+    table = []
+    for carry in range(2):
+        for value in range(256):
+            result, carry_out = operation(value, carry)
+            table.append((result, 0 if result != 0 else 1, carry_out))
+    return table
+
+
+rlc_table = shift_table(lambda value, carry: (((value << 1) | (value >> 7)) & 255, value >> 7))
+rrc_table = shift_table(lambda value, carry: ((value >> 1) | ((value & 1) << 7), value & 1))
+rl_table = shift_table(lambda value, carry: (((value << 1) | carry) & 255, value >> 7))
+rr_table = shift_table(lambda value, carry: ((value >> 1) | (carry << 7), value & 1))
+sla_table = shift_table(lambda value, carry: ((value << 1) & 255, value >> 7))
+sra_table = shift_table(lambda value, carry: ((value >> 1) | (value & 128), value & 1))
+swap_table = shift_table(lambda value, carry: ((value >> 4) | ((value & 15) << 4), 0))
+srl_table = shift_table(lambda value, carry: (value >> 1, value & 1))
+shift_tables = [rlc_table, rrc_table, rl_table, rr_table, sla_table, sra_table, swap_table, srl_table]
+
+# Z of BIT b for every value, one table per bit
+bit_zero = [bytes(1 - ((value >> b) & 1) for value in range(256)) for b in range(8)]
+
+
+def daa_entry(index):
+    # A, Z and C after DAA, for index = A | N << 8 | H << 9 | C << 10
+    value = index & 255
+    carry = index >> 10
+    correction = (0x06 if (index >> 9) & 1 else 0) | (0x60 if carry else 0)
+    if (index >> 8) & 1:
+        value -= correction
     else:
-        return ((val1 & carry_size) + (val2 & carry_size)) >> (bits)
+        correction |= 0x06 if (value & 0x0f) > 0x09 else 0
+        correction |= 0x60 if value > 0x99 else 0
+        value += correction
+    value &= 255
+    return value, 0 if value != 0 else 1, 1 if correction & 0x60 else carry
+
+
+daa_table = [daa_entry(index) for index in range(2048)]
+
+# For each value of IE & IF, the vector of the interrupt served first (the lowest bit) and that bit
+interrupt_table = [None] + [(0x40 + 8 * ((pending & -pending).bit_length() - 1), pending & -pending) for pending in range(1, 32)]
 
 
 def execute():
-    if registers.ime == 1:
+    if registers.halted:
+        idle()
+        return
+    if memory.pending != 0 and registers.ime == 1:
         run_interrupt()
     ticks = execute_instruction()
     post_execution(ticks)
 
+# Each function below takes the operands encoded in the opcode and returns the handler for it,
+# so the handlers only fetch the immediate bytes they actually use
 def nop():
-    registers.pc += 1
-    return 4
-def ld_r16_imm16():
-    registers.pc += 3
-    registers[operand_r16] = imm16
-    return 12
-
-def ld_r16mem_a():
-    registers.pc += 1
-    if dest_source_r16mem == "hl+":
-        registers["[hl]"] = registers["a"]
-        registers["hl"] += 1
-        registers["hl"] &= 65535
-    elif dest_source_r16mem == "hl-":
-        registers["[hl]"] = registers["a"]
-        registers["hl"] -= 1
-        registers["hl"] &= 65535
+    def handler():
+        registers.pc += 1
+        return 4
+    return handler
+
+def ld_r16_imm16(index):
+    set_r16 = r16_setters[index]
+    def handler():
+        pc = registers.pc
+        mem = memory.mem
+        registers.pc = pc + 3
+        set_r16(mem[pc + 1] | (mem[pc + 2] << 8))
+        return 12
+    return handler
+
+def ld_r16mem_a(index):
+    if index == 2:
+        def handler():
+            registers.pc += 1
+            hl = registers.hl
+            memory[hl] = registers.a
+            registers.hl = (hl + 1) & 65535
+            return 8
+    elif index == 3:
+        def handler():
+            registers.pc += 1
+            hl = registers.hl
+            memory[hl] = registers.a
+            registers.hl = (hl - 1) & 65535
+            return 8
     else:
-        memory[registers[dest_source_r16mem]] = registers["a"]
-    return 8
-
-
-def ld_a_r16mem():
-    registers.pc += 1
-    if dest_source_r16mem == "hl+":
-        registers["a"] = registers["[hl]"]
-        registers["hl"] += 1
-        registers["hl"] &= 65535
-    elif dest_source_r16mem == "hl-":
-        registers["a"] = registers["[hl]"]
-        registers["hl"] -= 1
-        registers["hl"] &= 65535
+        get_r16 = r16_getters[index]
+        def handler():
+            registers.pc += 1
+            memory[get_r16()] = registers.a
+            return 8
+    return handler
+
+def ld_a_r16mem(index):
+    if index == 2:
+        def handler():
+            registers.pc += 1
+            hl = registers.hl
+            registers.a = read(hl)
+            registers.hl = (hl + 1) & 65535
+            return 8
+    elif index == 3:
+        def handler():
+            registers.pc += 1
+            hl = registers.hl
+            registers.a = read(hl)
+            registers.hl = (hl - 1) & 65535
+            return 8
     else:
-        registers["a"] = memory[registers[dest_source_r16mem]]
-    return 8
+        get_r16 = r16_getters[index]
+        def handler():
+            registers.pc += 1
+            registers.a = read(get_r16())
+            return 8
+    return handler
 
 def ld_imm16_sp():
-    registers.pc += 3
-    memory[imm16] = registers["sp"] & 255
-    memory[imm16 + 1] = registers["sp"] >> 8
-    return 20
-
-def inc_r16():
-    registers.pc += 1
-    registers[operand_r16] += 1
-    registers[operand_r16] &= 65535
-    return 8
-
-def dec_r16():
-    registers.pc += 1
-    registers[operand_r16] -= 1
-    registers[operand_r16] &= 65535
-    return 8
-
-def add_hl_r16():
-    registers.pc += 1
-    registers.flagN = 0
-    registers.flagH = is_carry(registers["hl"], registers[operand_r16], 12, 0)
-    registers.flagC = is_carry(registers["hl"], registers[operand_r16], 16, 0)
-    registers["hl"] += registers[operand_r16]
-    registers["hl"] &= 65535
-    return 8
-
-def inc_r8():
-    registers.pc += 1
-    registers.flagH = is_carry(registers[operand_stk_r8], 1, 4, 0)
-    registers[operand_stk_r8] += 1
-    registers[operand_stk_r8] &= 255
-    registers.flagN = 0
-    registers.flagZ = 0 if registers[operand_stk_r8] != 0 else 1
-    return 4 if operand_stk_r8 != "[hl]" else 12
-
-def dec_r8():
-    registers.pc += 1
-    registers.flagH = is_carry(registers[operand_stk_r8], 1, 4, 1)
-    registers[operand_stk_r8] -= 1
-    registers[operand_stk_r8] &= 255
-    registers.flagN = 1
-    registers.flagZ = 0 if registers[operand_stk_r8] != 0 else 1
-    return 4 if operand_stk_r8 != "[hl]" else 12
-
-def ld_r8_imm8():
-    registers.pc += 2
-    registers[operand_stk_r8] = imm8
-    return 8 if registers[operand_stk_r8] != "[hl]" else 12
+    def handler():
+        pc = registers.pc
+        mem = memory.mem
+        registers.pc = pc + 3
+        addr = mem[pc + 1] | (mem[pc + 2] << 8)
+        memory[addr] = registers.sp & 255
+        memory[addr + 1] = registers.sp >> 8
+        return 20
+    return handler
+
+def inc_r16(index):
+    get_r16 = r16_getters[index]
+    set_r16 = r16_setters[index]
+    def handler():
+        registers.pc += 1
+        set_r16((get_r16() + 1) & 65535)
+        return 8
+    return handler
+
+def dec_r16(index):
+    get_r16 = r16_getters[index]
+    set_r16 = r16_setters[index]
+    def handler():
+        registers.pc += 1
+        set_r16((get_r16() - 1) & 65535)
+        return 8
+    return handler
+
+def add_hl_r16(index):
+    get_r16 = r16_getters[index]
+    def handler():
+        registers.pc += 1
+        hl = registers.hl
+        value = get_r16()
+        if registers.lazy_flags is not None:
+            registers.sync_flags()
+        registers.flagN = 0
+        result = hl + value
+        registers.flagH = ((hl & 0xfff) + (value & 0xfff)) >> 12
+        registers.flagC = result >> 16
+        registers.hl = result & 65535
+        return 8
+    return handler
+
+def inc_r8(index):
+    get_r8 = r8_getters[index]
+    set_r8 = r8_setters[index]
+    cycles = 4 if index != 6 else 12
+    def handler():
+        registers.pc += 1
+        value = get_r8()
+        set_r8((value + 1) & 255)
+        if registers.lazy_flags is not None:
+            registers.sync_carry()
+        registers.lazy_flags = (value, 1, value + 1, 0, True)
+        return cycles
+    return handler
+
+def dec_r8(index):
+    get_r8 = r8_getters[index]
+    set_r8 = r8_setters[index]
+    cycles = 4 if index != 6 else 12
+    def handler():
+        registers.pc += 1
+        value = get_r8()
+        set_r8((value - 1) & 255)
+        if registers.lazy_flags is not None:
+            registers.sync_carry()
+        registers.lazy_flags = (value, 1, value - 1, 1, True)
+        return cycles
+    return handler
+
+def ld_r8_imm8(index):
+    set_r8 = r8_setters[index]
+    cycles = 8 if index != 6 else 12
+    def handler():
+        pc = registers.pc
+        registers.pc = pc + 2
+        set_r8(memory.mem[pc + 1])
+        return cycles
+    return handler
 
 def rlca():
-    registers.pc += 1
-    registers.flagC = (registers["a"] & 128) >> 7
-    registers["a"] = (registers["a"] << 1) | registers.flagC
-    registers["a"] &= 255
-    registers.flagN = 0
-    registers.flagH = 0
-    registers.flagZ = 0
-    return 4
+    def handler():
+        registers.pc += 1
+        registers.a, _, registers.flagC = rlc_table[registers.a]
+        registers.lazy_flags = None
+        registers.flagN = 0
+        registers.flagH = 0
+        registers.flagZ = 0
+        return 4
+    return handler
 
 def rrca():
-    registers.pc += 1
-    registers.flagC = registers["a"] & 1
-    registers["a"] = (registers["a"] >> 1) | (registers.flagC << 7)
-    registers.flagN = 0
-    registers.flagH = 0
-    registers.flagZ = 0
-    return 4
+    def handler():
+        registers.pc += 1
+        registers.a, _, registers.flagC = rrc_table[registers.a]
+        registers.lazy_flags = None
+        registers.flagN = 0
+        registers.flagH = 0
+        registers.flagZ = 0
+        return 4
+    return handler
 
 def rla():
-    registers.pc += 1
-    registers["a"] = (registers["a"] << 1) | registers.flagC
-    registers.flagC = (registers["a"] >> 8)
-    registers["a"] &= 255
-    registers.flagN = 0
-    registers.flagH = 0
-    registers.flagZ = 0
-    return 4
+    def handler():
+        registers.pc += 1
+        registers.a, _, registers.flagC = rl_table[registers.a | (flag_c() << 8)]
+        registers.lazy_flags = None
+        registers.flagN = 0
+        registers.flagH = 0
+        registers.flagZ = 0
+        return 4
+    return handler
 
 def rra():
-    registers.pc += 1
-    prevC = registers.flagC
-    registers.flagC = registers["a"] & 1
-    registers["a"] = registers["a"] >> 1
-    registers["a"] |= (prevC << 7)
-    registers.flagN = 0
-    registers.flagH = 0
-    registers.flagZ = 0
-    return 4
+    def handler():
+        registers.pc += 1
+        registers.a, _, registers.flagC = rr_table[registers.a | (flag_c() << 8)]
+        registers.lazy_flags = None
+        registers.flagN = 0
+        registers.flagH = 0
+        registers.flagZ = 0
+        return 4
+    return handler
 
 def daa():
-    registers.pc += 1
-
-    temp = registers["a"]
-    corr = 0
-    corr |= 0x06 if (registers.flagH != 0) else 0x00
-    corr |= 0x60 if (registers.flagC != 0) else 0x00
-
-    if registers.flagN == 1:
-        temp -= corr
-    else:
-        corr |= 0x06 if (temp & 0x0f) > 0x09 else 0x00
-        corr |= 0x60 if temp > 0x99 else 0x00
-        temp += corr
-
-    if (corr & 0x60) != 0:
-        registers.flagC = 1
+    def handler():
+        registers.pc += 1
+        if registers.lazy_flags is not None:
+            registers.sync_flags()
+        registers.a, registers.flagZ, registers.flagC = daa_table[registers.a | (registers.flagN << 8) | (registers.flagH << 9) | (registers.flagC << 10)]
+        registers.flagH = 0
+        return 4
+    return handler
 
-    registers.flagH = 0
-
-    temp &= 255
-
-    registers["a"] = temp
-    registers.flagZ = 0 if registers["a"] != 0 else 1
-    return 4
 def cpl():
-    registers.pc += 1
-    registers["a"] = (~registers["a"]) & 255
-    registers.flagN = 1
-    registers.flagH = 1
-    return 4
+    def handler():
+        registers.pc += 1
+        if registers.lazy_flags is not None:
+            registers.sync_flags()
+        registers.a = (~registers.a) & 255
+        registers.flagN = 1
+        registers.flagH = 1
+        return 4
+    return handler
+
 def scf():
-    registers.pc += 1
-    registers.flagN = 0
-    registers.flagH = 0
-    registers.flagC = 1
-    return 4
+    def handler():
+        registers.pc += 1
+        if registers.lazy_flags is not None:
+            registers.sync_flags()
+        registers.flagN = 0
+        registers.flagH = 0
+        registers.flagC = 1
+        return 4
+    return handler
 
 def ccf():
-    registers.pc += 1
-    registers.flagN = 0
-    registers.flagH = 0
-    registers.flagC = 0 if registers.flagC == 1 else 1
-    return 4
+    def handler():
+        registers.pc += 1
+        if registers.lazy_flags is not None:
+            registers.sync_flags()
+        registers.flagN = 0
+        registers.flagH = 0
+        registers.flagC = 0 if registers.flagC == 1 else 1
+        return 4
+    return handler
+
 def jr():
-    global imm8
-    registers.pc += 2
-    if imm8 >= 128:
-        imm8 -= 256
-    registers.pc += imm8
-    return 12
-def jr_cond():
-    global imm8
-    registers.pc += 2
-    if imm8 >= 128:
-        imm8 -= 256
-    flag = False
-    if registers.flagC == 1 and condition == "c":
-        flag = True
-    elif registers.flagC == 0 and condition == "nc":
-        flag = True
-    elif registers.flagZ == 1 and condition == "z":
-        flag = True
-    elif registers.flagZ == 0 and condition == "nz":
-        flag = True
-    if flag:
-        registers.pc += imm8
+    def handler():
+        pc = registers.pc
+        offset = memory.mem[pc + 1]
+        registers.pc = pc + 2 + (offset - 256 if offset >= 128 else offset)
         return 12
-    else:
+    return handler
+
+def jr_cond(condition):
+    flag = condition_flags[condition]
+    taken = condition & 1
+    def handler():
+        pc = registers.pc
+        if flag() == taken:
+            offset = memory.mem[pc + 1]
+            registers.pc = pc + 2 + (offset - 256 if offset >= 128 else offset)
+            return 12
+        registers.pc = pc + 2
         return 8
+    return handler
+
+def stop():
+    def handler():
+        registers.pc += 2
+        registers.halted = True
+        registers.stopped = True
+        timer.reset_div()
+        return 4
+    return handler
+
+def halt():
+    def handler():
+        registers.pc += 1
+        registers.halted = True
+        if registers.ime == 0 and memory.pending != 0:
+            # HALT bug: the CPU does not halt and reads the next byte twice, idle runs that instruction
+            registers.halt_bug = True
+        return 4
+    return handler
+
+def ld_r8_r8(dest, source):
+    get_r8 = r8_getters[source]
+    set_r8 = r8_setters[dest]
+    cycles = 4 if source != 6 and dest != 6 else 8
+    def handler():
+        registers.pc += 1
+        set_r8(get_r8())
+        return cycles
+    return handler
+
+def add_a_r8(index):
+    get_r8 = r8_getters[index]
+    cycles = 4 if index != 6 else 8
+    def handler():
+        registers.pc += 1
+        value = get_r8()
+        a = registers.a
+        raw = a + value
+        registers.a = raw & 255
+        registers.lazy_flags = (a, value, raw, 0, False)
+        return cycles
+    return handler
+
+def adc_a_r8(index):
+    get_r8 = r8_getters[index]
+    cycles = 4 if index != 6 else 8
+    def handler():
+        registers.pc += 1
+        value = get_r8()
+        a = registers.a
+        raw = a + value + flag_c()
+        registers.a = raw & 255
+        registers.lazy_flags = (a, value, raw, 0, False)
+        return cycles
+    return handler
+
+def sub_a_r8(index):
+    get_r8 = r8_getters[index]
+    cycles = 4 if index != 6 else 8
+    def handler():
+        registers.pc += 1
+        value = get_r8()
+        a = registers.a
+        raw = a - value
+        registers.a = raw & 255
+        registers.lazy_flags = (a, value, raw, 1, False)
+        return cycles
+    return handler
+
+def sbc_a_r8(index):
+    get_r8 = r8_getters[index]
+    cycles = 4 if index != 6 else 8
+    def handler():
+        registers.pc += 1
+        value = get_r8()
+        a = registers.a
+        raw = a - value - flag_c()
+        registers.a = raw & 255
+        registers.lazy_flags = (a, value, raw, 1, False)
+        return cycles
+    return handler
+
+def and_a_r8(index):
+    get_r8 = r8_getters[index]
+    cycles = 4 if index != 6 else 8
+    def handler():
+        registers.pc += 1
+        registers.a &= get_r8()
+        registers.lazy_flags = None
+        registers.flagZ = 0 if registers.a != 0 else 1
+        registers.flagN = 0
+        registers.flagH = 1
+        registers.flagC = 0
+        return cycles
+    return handler
+
+def xor_a_r8(index):
+    get_r8 = r8_getters[index]
+    cycles = 4 if index != 6 else 8
+    def handler():
+        registers.pc += 1
+        registers.a ^= get_r8()
+        registers.lazy_flags = None
+        registers.flagZ = 0 if registers.a != 0 else 1
+        registers.flagN = 0
+        registers.flagH = 0
+        registers.flagC = 0
+        return cycles
+    return handler
+
+def or_a_r8(index):
+    get_r8 = r8_getters[index]
+    cycles = 4 if index != 6 else 8
+    def handler():
+        registers.pc += 1
+        registers.a |= get_r8()
+        registers.lazy_flags = None
+        registers.flagZ = 0 if registers.a != 0 else 1
+        registers.flagN = 0
+        registers.flagH = 0
+        registers.flagC = 0
+        return cycles
+    return handler
+
+def cp_a_r8(index):
+    get_r8 = r8_getters[index]
+    cycles = 4 if index != 6 else 8
+    def handler():
+        registers.pc += 1
+        value = get_r8()
+        a = registers.a
+        registers.lazy_flags = (a, value, a - value, 1, False)
+        return cycles
+    return handler
 
-def stop(): # TODO
-    registers.pc += 2
-    return 4
-def halt():  # TODO
-    registers.pc += 1
-    return 4
-def ld_r8_r8():
-    registers.pc += 1
-    registers[operand_stk_r8] = registers[operand_r8]
-    return 4 if operand_r8 != "[hl]" and operand_stk_r8 != "[hl]" else 8
-def add_a_r8():
-    registers.pc += 1
-    registers.flagH = is_carry(registers["a"], registers[operand_r8], 4, 0)
-    registers.flagC = is_carry(registers["a"], registers[operand_r8], 8, 0)
-    registers["a"] += registers[operand_r8]
-    registers["a"] &= 255
-    registers.flagN = 0
-    registers.flagZ = 0 if registers["a"] != 0 else 1
-    return 4 if operand_r8 != "[hl]" else 8
-def adc_a_r8():
-    registers.pc += 1
-    prevC = registers.flagC
-    registers.flagH = int((((registers["a"] & 15) + (registers[operand_r8] & 15) + registers.flagC) > 15))
-    registers.flagC = int((registers["a"] + registers[operand_r8] + prevC) > 255)
-    registers["a"] += registers[operand_r8] + prevC
-    registers["a"] &= 255
-    registers.flagN = 0
-    registers.flagZ = 0 if registers["a"] != 0 else 1
-    return 4 if operand_r8 != "[hl]" else 8
-def sub_a_r8():
-    registers.pc += 1
-    registers.flagH = is_carry(registers["a"], registers[operand_r8], 4, 1)
-    registers.flagC = is_carry(registers["a"], registers[operand_r8], 8, 1)
-    registers["a"] -= registers[operand_r8]
-    registers["a"] &= 255
-    registers.flagN = 1
-    registers.flagZ = 0 if registers["a"] != 0 else 1
-    return 4 if operand_r8 != "[hl]" else 8
-def sbc_a_r8():
-    registers.pc += 1
-    prevC = registers.flagC
-    registers.flagH = int((((registers["a"] & 15) - (registers[operand_r8] & 15) - registers.flagC) < 0))
-    registers.flagC = int((registers["a"] - registers[operand_r8] - prevC) < 0)
-    registers["a"] -= (registers[operand_r8] + prevC)
-    registers["a"] &= 255
-    registers.flagN = 1
-    registers.flagZ = 0 if registers["a"] != 0 else 1
-    return 4 if operand_r8 != "[hl]" else 8
-def and_a_r8():
-    registers.pc += 1
-    registers["a"] &= registers[operand_r8]
-    registers.flagZ = 0 if registers["a"] != 0 else 1
-    registers.flagN = 0
-    registers.flagH = 1
-    registers.flagC = 0
-    return 4 if operand_r8 != "[hl]" else 8
-def xor_a_r8():
-    registers.pc += 1
-    registers["a"] ^= registers[operand_r8]
-    registers.flagZ = 0 if registers["a"] != 0 else 1
-    registers.flagN = 0
-    registers.flagH = 0
-    registers.flagC = 0
-    return 4 if operand_r8 != "[hl]" else 8
-def or_a_r8():
-    registers.pc += 1
-    registers["a"] |= registers[operand_r8]
-    registers.flagZ = 0 if registers["a"] != 0 else 1
-    registers.flagN = 0
-    registers.flagH = 0
-    registers.flagC = 0
-    return 4 if operand_r8 != "[hl]" else 8
-def cp_a_r8():
-    registers.pc += 1
-    temp = registers["a"] - registers[operand_r8]
-    temp &= 255
-    registers.flagZ = 0 if temp != 0 else 1
-    registers.flagN = 1
-    registers.flagH = is_carry(registers["a"], registers[operand_r8], 4, 1)
-    registers.flagC = is_carry(registers["a"], registers[operand_r8], 8, 1)
-    return 4 if operand_r8 != "[hl]" else 8
 def add_a_imm8():
-    registers.pc += 2
-    registers.flagH = is_carry(registers["a"], imm8, 4, 0)
-    registers.flagC = is_carry(registers["a"], imm8, 8, 0)
-    registers["a"] += imm8
-    registers["a"] &= 255
-    registers.flagN = 0
-    registers.flagZ = 0 if registers["a"] != 0 else 1
-    return 8
+    def handler():
+        pc = registers.pc
+        registers.pc = pc + 2
+        imm8 = memory.mem[pc + 1]
+        a = registers.a
+        raw = a + imm8
+        registers.a = raw & 255
+        registers.lazy_flags = (a, imm8, raw, 0, False)
+        return 8
+    return handler
+
 def adc_a_imm8():
-    registers.pc += 2
-    prevC = registers.flagC
-    registers.flagH = int((((registers["a"] & 15) + (imm8 & 15) + registers.flagC) > 15))
-    registers.flagC = int((registers["a"] + imm8 + prevC) > 255)
-    registers["a"] += (imm8 + prevC)
-    registers["a"] &= 255
-    registers.flagN = 0
-    registers.flagZ = 0 if registers["a"] != 0 else 1
-    return 8
+    def handler():
+        pc = registers.pc
+        registers.pc = pc + 2
+        imm8 = memory.mem[pc + 1]
+        a = registers.a
+        raw = a + imm8 + flag_c()
+        registers.a = raw & 255
+        registers.lazy_flags = (a, imm8, raw, 0, False)
+        return 8
+    return handler
+
 def sub_a_imm8():
-    registers.pc += 2
-    registers.flagH = is_carry(registers["a"], imm8, 4, 1)
-    registers.flagC = is_carry(registers["a"], imm8, 8, 1)
-    registers["a"] -= imm8
-    registers["a"] &= 255
-    registers.flagN = 1
-    registers.flagZ = 0 if registers["a"] != 0 else 1
-    return 8
+    def handler():
+        pc = registers.pc
+        registers.pc = pc + 2
+        imm8 = memory.mem[pc + 1]
+        a = registers.a
+        raw = a - imm8
+        registers.a = raw & 255
+        registers.lazy_flags = (a, imm8, raw, 1, False)
+        return 8
+    return handler
+
 def sbc_a_imm8():
-    registers.pc += 2
-    prevC = registers.flagC
-    registers.flagH = int((((registers["a"] & 15) - (imm8 & 15) - registers.flagC) < 0))
-    registers.flagC = int((registers["a"] - imm8 - prevC) < 0)
-    registers["a"] -= imm8 + prevC
-    registers["a"] &= 255
-    registers.flagN = 1
-    registers.flagZ = 0 if registers["a"] != 0 else 1
-    return 8
+    def handler():
+        pc = registers.pc
+        registers.pc = pc + 2
+        imm8 = memory.mem[pc + 1]
+        a = registers.a
+        raw = a - imm8 - flag_c()
+        registers.a = raw & 255
+        registers.lazy_flags = (a, imm8, raw, 1, False)
+        return 8
+    return handler
+
 def and_a_imm8():
-    registers.pc += 2
-    registers["a"] &= imm8
-    registers.flagZ = 0 if registers["a"] != 0 else 1
-    registers.flagN = 0
-    registers.flagH = 1
-    registers.flagC = 0
-    return 8
+    def handler():
+        pc = registers.pc
+        registers.pc = pc + 2
+        registers.a &= memory.mem[pc + 1]
+        registers.lazy_flags = None
+        registers.flagZ = 0 if registers.a != 0 else 1
+        registers.flagN = 0
+        registers.flagH = 1
+        registers.flagC = 0
+        return 8
+    return handler
+
 def xor_a_imm8():
-    registers.pc += 2
-    registers["a"] ^= imm8
-    registers.flagZ = 0 if registers["a"] != 0 else 1
-    registers.flagN = 0
-    registers.flagH = 0
-    registers.flagC = 0
-    return 8
+    def handler():
+        pc = registers.pc
+        registers.pc = pc + 2
+        registers.a ^= memory.mem[pc + 1]
+        registers.lazy_flags = None
+        registers.flagZ = 0 if registers.a != 0 else 1
+        registers.flagN = 0
+        registers.flagH = 0
+        registers.flagC = 0
+        return 8
+    return handler
+
 def or_a_imm8():
-    registers.pc += 2
-    registers["a"] |= imm8
-    registers.flagZ = 0 if registers["a"] != 0 else 1
-    registers.flagN = 0
-    registers.flagH = 0
-    registers.flagC = 0
-    return 8
+    def handler():
+        pc = registers.pc
+        registers.pc = pc + 2
+        registers.a |= memory.mem[pc + 1]
+        registers.lazy_flags = None
+        registers.flagZ = 0 if registers.a != 0 else 1
+        registers.flagN = 0
+        registers.flagH = 0
+        registers.flagC = 0
+        return 8
+    return handler
+
 def cp_a_imm8():
-    registers.pc += 2
-    temp = registers["a"] - imm8
-    temp &= 255
-    registers.flagZ = 0 if temp != 0 else 1
-    registers.flagN = 1
-    registers.flagH = is_carry(registers["a"], imm8, 4, 1)
-    registers.flagC = is_carry(registers["a"], imm8, 8, 1)
-    return 8
-def ret_cond():
-    registers.pc += 1
-    flag = False
-    if registers.flagC == 1 and condition == "c":
-        flag = True
-    elif registers.flagC == 0 and condition == "nc":
-        flag = True
-    elif registers.flagZ == 1 and condition == "z":
-        flag = True
-    elif registers.flagZ == 0 and condition == "nz":
-        flag = True
-    if flag:
-        registers.pc = memory[registers["sp"]] & 255
-        registers["sp"] += 1
-        registers["sp"] &= 65535
-        registers.pc += memory[registers["sp"]] << 8
-        registers["sp"] += 1
-        registers["sp"] &= 65535
-        return 20
-    else:
+    def handler():
+        pc = registers.pc
+        registers.pc = pc + 2
+        imm8 = memory.mem[pc + 1]
+        a = registers.a
+        registers.lazy_flags = (a, imm8, a - imm8, 1, False)
+        return 8
+    return handler
+
+def pop_word():
+    sp = registers.sp
+    mem = memory.mem
+    value = mem[sp] | (mem[(sp + 1) & 65535] << 8)
+    registers.sp = (sp + 2) & 65535
+    return value
+
+def push_word(value):
+    sp = (registers.sp - 1) & 65535
+    memory[sp] = value >> 8
+    sp = (sp - 1) & 65535
+    memory[sp] = value & 255
+    registers.sp = sp
+
+def ret_cond(condition):
+    flag = condition_flags[condition]
+    taken = condition & 1
+    def handler():
+        if flag() == taken:
+            registers.pc = pop_word()
+            return 20
+        registers.pc += 1
         return 16
+    return handler
+
 def ret():
-    registers.pc = memory[registers["sp"]] & 255
-    registers["sp"] += 1
-    registers["sp"] &= 65535
-    registers.pc += memory[registers["sp"]] << 8
-    registers["sp"] += 1
-    registers["sp"] &= 65535
-    return 16
+    def handler():
+        registers.pc = pop_word()
+        return 16
+    return handler
+
 def reti():
-    registers.pc = memory[registers["sp"]] & 255
-    registers["sp"] += 1
-    registers["sp"] &= 65535
-    registers.pc += memory[registers["sp"]] << 8
-    registers["sp"] += 1
-    registers["sp"] &= 65535
-    registers.ime = 1
-    return 16
-def jp_cond():
-    registers.pc += 3
-    flag = False
-    if registers.flagC == 1 and condition == "c":
-        flag = True
-    elif registers.flagC == 0 and condition == "nc":
-        flag = True
-    elif registers.flagZ == 1 and condition == "z":
-        flag = True
-    elif registers.flagZ == 0 and condition == "nz":
-        flag = True
-    if flag:
-        registers.pc = imm16
+    def handler():
+        registers.pc = pop_word()
+        registers.ime = 1
         return 16
-    else:
+    return handler
+
+def jp_cond(condition):
+    flag = condition_flags[condition]
+    taken = condition & 1
+    def handler():
+        pc = registers.pc
+        if flag() == taken:
+            mem = memory.mem
+            registers.pc = mem[pc + 1] | (mem[pc + 2] << 8)
+            return 16
+        registers.pc = pc + 3
         return 12
+    return handler
+
 def jp():
-    registers.pc = imm16
-    return 16
+    def handler():
+        pc = registers.pc
+        mem = memory.mem
+        registers.pc = mem[pc + 1] | (mem[pc + 2] << 8)
+        return 16
+    return handler
+
 def jp_hl():
-    registers.pc = registers["hl"]
-    return 4
-def call_cond():
-    registers.pc += 3
-    flag = False
-    if registers.flagC == 1 and condition == "c":
-        flag = True
-    elif registers.flagC == 0 and condition == "nc":
-        flag = True
-    elif registers.flagZ == 1 and condition == "z":
-        flag = True
-    elif registers.flagZ == 0 and condition == "nz":
-        flag = True
-    if flag:
-        registers["sp"] -= 1
-        registers["sp"] &= 65535
-        memory[registers["sp"]] = registers.pc >> 8
-        registers["sp"] -= 1
-        registers["sp"] &= 65535
-        memory[registers["sp"]] = registers.pc & 255
-        registers.pc = imm16
-        return 24
-    else:
+    def handler():
+        registers.pc = registers.hl
+        return 4
+    return handler
+
+def call_cond(condition):
+    flag = condition_flags[condition]
+    taken = condition & 1
+    def handler():
+        pc = registers.pc
+        if flag() == taken:
+            mem = memory.mem
+            push_word(pc + 3)
+            registers.pc = mem[pc + 1] | (mem[pc + 2] << 8)
+            return 24
+        registers.pc = pc + 3
         return 12
+    return handler
+
 def call():
-    registers.pc += 3
-    registers["sp"] -= 1
-    registers["sp"] &= 65535
-    memory[registers["sp"]] = registers.pc >> 8
-    registers["sp"] -= 1
-    registers["sp"] &= 65535
-    memory[registers["sp"]] = registers.pc & 255
-    registers.pc = imm16
-    return 24
-def rst():
-    registers.pc += 1
-    registers["sp"] -= 1
-    registers["sp"] &= 65535
-    memory[registers["sp"]] = registers.pc >> 8
-    registers["sp"] -= 1
-    registers["sp"] &= 65535
-    memory[registers["sp"]] = registers.pc & 255
-    registers.pc = tgt3
-    return 16
-def pop():
-    registers.pc += 1
-    registers[operand_stk_r16] = memory[registers["sp"]] & 255
-    registers["sp"] += 1
-    registers["sp"] &= 65535
-    registers[operand_stk_r16] += memory[registers["sp"]] << 8
-    registers["sp"] += 1
-    registers["sp"] &= 65535
-    return 12
-def push():
-    registers.pc += 1
-    registers["sp"] -= 1
-    registers["sp"] &= 65535
-    memory[registers["sp"]] = registers[operand_stk_r16] >> 8
-    registers["sp"] -= 1
-    registers["sp"] &= 65535
-    memory[registers["sp"]] = registers[operand_stk_r16] & 255
-    return 16
+    def handler():
+        pc = registers.pc
+        mem = memory.mem
+        push_word(pc + 3)
+        registers.pc = mem[pc + 1] | (mem[pc + 2] << 8)
+        return 24
+    return handler
+
+def rst(target):
+    def handler():
+        push_word(registers.pc + 1)
+        registers.pc = target
+        return 16
+    return handler
+
+def pop(index):
+    set_r16stk = r16stk_setters[index]
+    def handler():
+        registers.pc += 1
+        set_r16stk(pop_word())
+        return 12
+    return handler
+
+def push(index):
+    get_r16stk = r16stk_getters[index]
+    def handler():
+        registers.pc += 1
+        push_word(get_r16stk())
+        return 16
+    return handler
+
 def prefix():
-    global b3
-    b3 = (imm8 & 0b00111000) >> 3
-    return jump_table_cb[imm8]()
+    def handler():
+        return jump_table_cb[memory.mem[registers.pc + 1]]()
+    return handler
+
 def add_sp_imm8():
-    global imm8
-    registers.pc += 2
-    if imm8 > 127:
-        imm8 -= 256
-
-    registers.flagZ = 0
-    registers.flagN = 0
-    registers.flagH = is_carry(registers["sp"], imm8, 4, 0)
-    registers.flagC = is_carry(registers["sp"], imm8, 8, 0)
-
-    registers["sp"] += imm8
-    registers["sp"] &= 65535
-    return 16
+    def handler():
+        pc = registers.pc
+        registers.pc = pc + 2
+        value = memory.mem[pc + 1]
+        offset = value - 256 if value > 127 else value
+        sp = registers.sp
+
+        # H and C come from the unsigned add of the low byte, whatever the sign of the offset
+        registers.lazy_flags = None
+        registers.flagZ = 0
+        registers.flagN = 0
+        registers.flagH = ((sp & 0xf) + (value & 0xf)) >> 4
+        registers.flagC = ((sp & 0xff) + value) >> 8
+
+        registers.sp = (sp + offset) & 65535
+        return 16
+    return handler
+
 def add_hl_sp_imm8():
-    global imm8
-    registers.pc += 2
-    if imm8 > 127:
-        imm8 -= 256
-
-    registers.flagZ = 0
-    registers.flagN = 0
-    registers.flagH = is_carry(registers["sp"], imm8, 4, 0)
-    registers.flagC = is_carry(registers["sp"], imm8, 8, 0)
-
-    registers["hl"] = registers["sp"] + imm8
-    registers["hl"] &= 65535
-    return 12
+    def handler():
+        pc = registers.pc
+        registers.pc = pc + 2
+        value = memory.mem[pc + 1]
+        offset = value - 256 if value > 127 else value
+        sp = registers.sp
+
+        # H and C come from the unsigned add of the low byte, whatever the sign of the offset
+        registers.lazy_flags = None
+        registers.flagZ = 0
+        registers.flagN = 0
+        registers.flagH = ((sp & 0xf) + (value & 0xf)) >> 4
+        registers.flagC = ((sp & 0xff) + value) >> 8
+
+        registers.hl = (sp + offset) & 65535
+        return 12
+    return handler
+
 def ld_sp_hl():
-    registers.pc += 1
-    registers["sp"] = registers["hl"]
-    return 8
+    def handler():
+        registers.pc += 1
+        registers.sp = registers.hl
+        return 8
+    return handler
+
 def di():
-    registers.pc += 1
-    registers.ime = 0
-    return 4
+    def handler():
+        registers.pc += 1
+        registers.ime = 0
+        return 4
+    return handler
+
 def ei():
-    registers.pc += 1
-    if registers.ime == 0:
-        registers.ime_to_be_setted += 1
-    return 4
+    def handler():
+        registers.pc += 1
+        if registers.ime == 0:
+            registers.ime_to_be_setted += 1
+        return 4
+    return handler
+
 def ldh_imm8_a():
-    registers.pc += 2
-    memory[0xff00 + imm8] = registers["a"]
-    return 12
+    def handler():
+        pc = registers.pc
+        registers.pc = pc + 2
+        memory[0xff00 + memory.mem[pc + 1]] = registers.a
+        return 12
+    return handler
+
 def ldh_a_imm8():
-    registers.pc += 2
-    registers["a"] = memory[0xff00 + imm8]
-    return 12
+    def handler():
+        pc = registers.pc
+        mem = memory.mem
+        registers.pc = pc + 2
+        registers.a = memory.read_io(0xff00 + mem[pc + 1])
+        return 12
+    return handler
+
 def ldh_c_a():
-    registers.pc += 1
-    memory[0xff00 + registers["c"]] = registers["a"]
-    return 8
+    def handler():
+        registers.pc += 1
+        memory[0xff00 + registers.c] = registers.a
+        return 8
+    return handler
+
 def ldh_a_c():
-    registers.pc += 1
-    registers["a"] = memory[0xff00 + registers["c"]]
-    return 8
+    def handler():
+        registers.pc += 1
+        registers.a = memory.read_io(0xff00 + registers.c)
+        return 8
+    return handler
+
 def ld_imm16_a():
-    registers.pc += 3
-    memory[imm16] = registers["a"]
-    return 16
+    def handler():
+        pc = registers.pc
+        mem = memory.mem
+        registers.pc = pc + 3
+        memory[mem[pc + 1] | (mem[pc + 2] << 8)] = registers.a
+        return 16
+    return handler
+
 def ld_a_imm16():
-    registers.pc += 3
-    registers["a"] = memory[imm16]
-    return 16
+    def handler():
+        pc = registers.pc
+        mem = memory.mem
+        registers.pc = pc + 3
+        registers.a = read(mem[pc + 1] | (mem[pc + 2] << 8))
+        return 16
+    return handler
+
 def invalid():
-    pass
-
-def rlc_r8():
-    registers.pc += 2
-    registers.flagC = (registers[operand_r8] & 128) >> 7
-    registers[operand_r8] = (registers[operand_r8] << 1) | registers.flagC
-    registers[operand_r8] &= 255
-    registers.flagN = 0
-    registers.flagH = 0
-    registers.flagZ = 0 if registers[operand_r8] != 0 else 1
-    return 8 if operand_r8 != "[hl]" else 16
-def rrc_r8():
-    registers.pc += 2
-    registers.flagC = registers[operand_r8] & 1
-    registers[operand_r8] = (registers[operand_r8] >> 1) | (registers.flagC << 7)
-    registers.flagN = 0
-    registers.flagH = 0
-    registers.flagZ = 0 if registers[operand_r8] != 0 else 1
-    return 8 if operand_r8 != "[hl]" else 16
-def rl_r8():
-    registers.pc += 2
-    registers[operand_r8] = (registers[operand_r8] << 1) | registers.flagC
-    registers.flagC = (registers[operand_r8] >> 8)
-    registers[operand_r8] &= 255
-    registers.flagN = 0
-    registers.flagH = 0
-    registers.flagZ = 0 if registers[operand_r8] != 0 else 1
-    return 8 if operand_r8 != "[hl]" else 16
-def rr_r8():
-    registers.pc += 2
-    prevC = registers.flagC
-    registers.flagC = registers[operand_r8] & 1
-    registers[operand_r8] = registers[operand_r8] >> 1
-    registers[operand_r8] += (prevC << 7)
-    registers.flagN = 0
-    registers.flagH = 0
-    registers.flagZ = 0 if registers[operand_r8] != 0 else 1
-    return 8 if operand_r8 != "[hl]" else 16
-def sla_r8():
-    registers.pc += 2
-    registers[operand_r8] = (registers[operand_r8] << 1)
-    registers.flagC = (registers[operand_r8] >> 8)
-    registers[operand_r8] &= 255
-    registers.flagN = 0
-    registers.flagH = 0
-    registers.flagZ = 0 if registers[operand_r8] != 0 else 1
-    return 8 if operand_r8 != "[hl]" else 16
-def sra_r8():
-    registers.pc += 2
-    registers.flagC = registers[operand_r8] & 1
-    registers[operand_r8] = (registers[operand_r8] >> 1)
-    registers[operand_r8] |= (registers[operand_r8] & 64) << 1
-    registers.flagN = 0
-    registers.flagH = 0
-    registers.flagZ = 0 if registers[operand_r8] != 0 else 1
-    return 8 if operand_r8 != "[hl]" else 16
-def swap_r8():
-    registers.pc += 2
-    low = registers[operand_r8] & 15
-    registers[operand_r8] = registers[operand_r8] >> 4
-    registers[operand_r8] += low << 4
-    registers.flagN = 0
-    registers.flagH = 0
-    registers.flagC = 0
-    registers.flagZ = 0 if registers[operand_r8] != 0 else 1
-    return 8 if operand_r8 != "[hl]" else 16
-def srl_r8():
-    registers.pc += 2
-    registers.flagN = 0
-    registers.flagH = 0
-    registers.flagC = registers[operand_r8] & 1
-    registers[operand_r8] = (registers[operand_r8] >> 1) & 127
-    registers.flagZ = 0 if registers[operand_r8] != 0 else 1
-    return 8 if operand_r8 != "[hl]" else 16
-def bit():
-    registers.pc += 2
-    iszero = (registers[operand_r8] >> b3) & 1
-    registers.flagZ = 1 if iszero == 0 else 0
-    registers.flagN = 0
-    registers.flagH = 1
-    return 8 if operand_r8 != "[hl]" else 12
-def res():
-    registers.pc += 2
-    registers[operand_r8] &= (255 - (2 ** b3))
-    return 8 if operand_r8 != "[hl]" else 16
-def set():
-    registers.pc += 2
-    registers[operand_r8] |= (1 << b3)
-    return 8 if operand_r8 != "[hl]" else 16
+    def handler():
+        pass
+    return handler
+
+def shift_r8(table, index, carry_in):
+    # Rotates, shifts and SWAP only differ in their table, RL and RR also index it with the carry
+    get_r8 = r8_getters[index]
+    set_r8 = r8_setters[index]
+    cycles = 8 if index != 6 else 16
+    if carry_in:
+        def handler():
+            registers.pc += 2
+            value, registers.flagZ, registers.flagC = table[get_r8() | (flag_c() << 8)]
+            set_r8(value)
+            registers.lazy_flags = None
+            registers.flagN = 0
+            registers.flagH = 0
+            return cycles
+    else:
+        def handler():
+            registers.pc += 2
+            value, registers.flagZ, registers.flagC = table[get_r8()]
+            set_r8(value)
+            registers.lazy_flags = None
+            registers.flagN = 0
+            registers.flagH = 0
+            return cycles
+    return handler
+
+def bit(b3, index):
+    get_r8 = r8_getters[index]
+    zero = bit_zero[b3]
+    cycles = 8 if index != 6 else 12
+    def handler():
+        registers.pc += 2
+        if registers.lazy_flags is not None:
+            registers.sync_carry()
+        registers.flagZ = zero[get_r8()]
+        registers.flagN = 0
+        registers.flagH = 1
+        return cycles
+    return handler
+
+def res(b3, index):
+    get_r8 = r8_getters[index]
+    set_r8 = r8_setters[index]
+    mask = 255 ^ (1 << b3)
+    cycles = 8 if index != 6 else 16
+    def handler():
+        registers.pc += 2
+        set_r8(get_r8() & mask)
+        return cycles
+    return handler
+
+def set(b3, index):
+    get_r8 = r8_getters[index]
+    set_r8 = r8_setters[index]
+    mask = 1 << b3
+    cycles = 8 if index != 6 else 16
+    def handler():
+        registers.pc += 2
+        set_r8(get_r8() | mask)
+        return cycles
+    return handler
 
 def generate_table():
-    jumpt = [invalid for _ in range(256)]
+    jumpt = [invalid() for _ in range(256)]
 
     for opcode in range(256):
+        # Operand fields of the opcode, only the ones the instruction encodes are used
+        r8_index = opcode & 0b00000111
+        stk_r8_index = (opcode & 0b00111000) >> 3
+        r16_index = (opcode & 0b00110000) >> 4
+        condition = (opcode & 0b00011000) >> 3
+
         if opcode == 0x00:
-            jumpt[opcode] = nop
+            jumpt[opcode] = nop()
         elif opcode in [0x01, 0x11, 0x21, 0x31]:
-            jumpt[opcode] = ld_r16_imm16
+            jumpt[opcode] = ld_r16_imm16(r16_index)
         elif opcode in [0x02, 0x12, 0x22, 0x32]:
-            jumpt[opcode] = ld_r16mem_a
+            jumpt[opcode] = ld_r16mem_a(r16_index)
         elif opcode in [0x0a, 0x1a, 0x2a, 0x3a]:
-            jumpt[opcode] = ld_a_r16mem
+            jumpt[opcode] = ld_a_r16mem(r16_index)
         elif opcode == 0x08:
-            jumpt[opcode] = ld_imm16_sp
+            jumpt[opcode] = ld_imm16_sp()
         elif opcode in [0x03, 0x13, 0x23, 0x33]:
-            jumpt[opcode] = inc_r16
+            jumpt[opcode] = inc_r16(r16_index)
         elif opcode in [0x0b, 0x1b, 0x2b, 0x3b]:
-            jumpt[opcode] = dec_r16
+            jumpt[opcode] = dec_r16(r16_index)
         elif opcode in [0x09, 0x19, 0x29, 0x39]:
-            jumpt[opcode] = add_hl_r16
+            jumpt[opcode] = add_hl_r16(r16_index)
         elif opcode in [0x04, 0x14, 0x24, 0x34, 0x0c, 0x1c, 0x2c, 0x3c]:
-            jumpt[opcode] = inc_r8
+            jumpt[opcode] = inc_r8(stk_r8_index)
         elif opcode in [0x05, 0x15, 0x25, 0x35, 0x0d, 0x1d, 0x2d, 0x3d]:
-            jumpt[opcode] = dec_r8
+            jumpt[opcode] = dec_r8(stk_r8_index)
         elif opcode in [0x06, 0x16, 0x26, 0x36, 0x0e, 0x1e, 0x2e, 0x3e]:
-            jumpt[opcode] = ld_r8_imm8
+            jumpt[opcode] = ld_r8_imm8(stk_r8_index)
         elif opcode == 0x07:
-            jumpt[opcode] = rlca
+            jumpt[opcode] = rlca()
         elif opcode == 0x0f:
-            jumpt[opcode] = rrca
+            jumpt[opcode] = rrca()
         elif opcode == 0x17:
-            jumpt[opcode] = rla
+            jumpt[opcode] = rla()
         elif opcode == 0x1f:
-            jumpt[opcode] = rra
+            jumpt[opcode] = rra()
         elif opcode == 0x27:
-            jumpt[opcode] = daa
+            jumpt[opcode] = daa()
         elif opcode == 0x2f:
-            jumpt[opcode] = cpl
+            jumpt[opcode] = cpl()
         elif opcode == 0x37:
-            jumpt[opcode] = scf
+            jumpt[opcode] = scf()
         elif opcode == 0x3f:
-            jumpt[opcode] = ccf
+            jumpt[opcode] = ccf()
         elif opcode == 0x18:
-            jumpt[opcode] = jr
+            jumpt[opcode] = jr()
         elif opcode in [0x20, 0x30, 0x28, 0x38]:
-            jumpt[opcode] = jr_cond
+            jumpt[opcode] = jr_cond(condition)
         elif opcode == 0x10:
-            jumpt[opcode] = stop
+            jumpt[opcode] = stop()
         elif opcode == 0x76:
-            jumpt[opcode] = halt
+            jumpt[opcode] = halt()
         elif 0x40 <= opcode <= 0x7f and opcode != 0x76:
-            jumpt[opcode] = ld_r8_r8
+            jumpt[opcode] = ld_r8_r8(stk_r8_index, r8_index)
         elif 0x80 <= opcode <= 0x87:
-            jumpt[opcode] = add_a_r8
+            jumpt[opcode] = add_a_r8(r8_index)
         elif 0x88 <= opcode <= 0x8f:
-            jumpt[opcode] = adc_a_r8
+            jumpt[opcode] = adc_a_r8(r8_index)
         elif 0x90 <= opcode <= 0x97:
-            jumpt[opcode] = sub_a_r8
+            jumpt[opcode] = sub_a_r8(r8_index)
         elif 0x98 <= opcode <= 0x9f:
-            jumpt[opcode] = sbc_a_r8
+            jumpt[opcode] = sbc_a_r8(r8_index)
         elif 0xa0 <= opcode <= 0xa7:
-            jumpt[opcode] = and_a_r8
+            jumpt[opcode] = and_a_r8(r8_index)
         elif 0xa8 <= opcode <= 0xaf:
-            jumpt[opcode] = xor_a_r8
+            jumpt[opcode] = xor_a_r8(r8_index)
         elif 0xb0 <= opcode <= 0xb7:
-            jumpt[opcode] = or_a_r8
+            jumpt[opcode] = or_a_r8(r8_index)
         elif 0xb8 <= opcode <= 0Xbf:
-            jumpt[opcode] = cp_a_r8
+            jumpt[opcode] = cp_a_r8(r8_index)
         elif opcode == 0xc6:
-            jumpt[opcode] = add_a_imm8
+            jumpt[opcode] = add_a_imm8()
         elif opcode == 0xce:
-            jumpt[opcode] = adc_a_imm8
+            jumpt[opcode] = adc_a_imm8()
         elif opcode == 0xd6:
-            jumpt[opcode] = sub_a_imm8
+            jumpt[opcode] = sub_a_imm8()
         elif opcode == 0xde:
-            jumpt[opcode] = sbc_a_imm8
+            jumpt[opcode] = sbc_a_imm8()
         elif opcode == 0xe6:
-            jumpt[opcode] = and_a_imm8
+            jumpt[opcode] = and_a_imm8()
         elif opcode == 0xee:
-            jumpt[opcode] = xor_a_imm8
+            jumpt[opcode] = xor_a_imm8()
         elif opcode == 0xf6:
-            jumpt[opcode] = or_a_imm8
+            jumpt[opcode] = or_a_imm8()
         elif opcode == 0xfe:
-            jumpt[opcode] = cp_a_imm8
+            jumpt[opcode] = cp_a_imm8()
         elif opcode in [0xc0, 0xd0, 0xc8, 0xd8]:
-            jumpt[opcode] = ret_cond
+            jumpt[opcode] = ret_cond(condition)
         elif opcode == 0xc9:
-            jumpt[opcode] = ret
+            jumpt[opcode] = ret()
         elif opcode == 0xd9:
-            jumpt[opcode] = reti
+            jumpt[opcode] = reti()
         elif opcode in [0xc2, 0xd2, 0xca, 0xda]:
-            jumpt[opcode] = jp_cond
+            jumpt[opcode] = jp_cond(condition)
         elif opcode == 0xc3:
-            jumpt[opcode] = jp
+            jumpt[opcode] = jp()
         elif opcode == 0xe9:
-            jumpt[opcode] = jp_hl
+            jumpt[opcode] = jp_hl()
         elif opcode in [0xc4, 0xd4, 0xcc, 0xdc]:
-            jumpt[opcode] = call_cond
+            jumpt[opcode] = call_cond(condition)
         elif opcode == 0xcd:
-            jumpt[opcode] = call
+            jumpt[opcode] = call()
         elif opcode in [0xc7, 0xd7, 0xe7, 0xf7, 0xcf, 0xdf, 0xef, 0xff]:
-            jumpt[opcode] = rst
+            jumpt[opcode] = rst(rst_vec[stk_r8_index])
         elif opcode in [0xc1, 0xd1, 0xe1, 0xf1]:
-            jumpt[opcode] = pop
+            jumpt[opcode] = pop(r16_index)
         elif opcode in [0xc5, 0xd5, 0xe5, 0xf5]:
-            jumpt[opcode] = push
+            jumpt[opcode] = push(r16_index)
         elif opcode == 0xcb:
-            jumpt[opcode] = prefix
+            jumpt[opcode] = prefix()
         elif opcode == 0xe8:
-            jumpt[opcode] = add_sp_imm8
+            jumpt[opcode] = add_sp_imm8()
         elif opcode == 0xf8:
-            jumpt[opcode] = add_hl_sp_imm8
+            jumpt[opcode] = add_hl_sp_imm8()
         elif opcode == 0xf9:
-            jumpt[opcode] = ld_sp_hl
+            jumpt[opcode] = ld_sp_hl()
         elif opcode == 0xf3:
-            jumpt[opcode] = di
+            jumpt[opcode] = di()
         elif opcode == 0xfb:
-            jumpt[opcode] = ei
+            jumpt[opcode] = ei()
         elif opcode == 0xe0:
-            jumpt[opcode] = ldh_imm8_a
+            jumpt[opcode] = ldh_imm8_a()
         elif opcode == 0xf0:
-            jumpt[opcode] = ldh_a_imm8
+            jumpt[opcode] = ldh_a_imm8()
         elif opcode == 0xe2:
-            jumpt[opcode] = ldh_c_a
+            jumpt[opcode] = ldh_c_a()
         elif opcode == 0xf2:
-            jumpt[opcode] = ldh_a_c
+            jumpt[opcode] = ldh_a_c()
         elif opcode == 0xea:
-            jumpt[opcode] = ld_imm16_a
+            jumpt[opcode] = ld_imm16_a()
         elif opcode == 0xfa:
-            jumpt[opcode] = ld_a_imm16
+            jumpt[opcode] = ld_a_imm16()
     return jumpt
 
 def generate_table_cb():
-    jumpt = [invalid for _ in range(256)]
+    jumpt = [invalid() for _ in range(256)]
 
     for opcode in range(256):
-        if opcode <= 0x07:
-            jumpt[opcode] = rlc_r8
-        elif opcode <= 0x0f:
-            jumpt[opcode] = rrc_r8
-        elif opcode <= 0x17:
-            jumpt[opcode] = rl_r8
-        elif opcode <= 0x1f:
-            jumpt[opcode] = rr_r8
-        elif opcode <= 0x27:
-            jumpt[opcode] = sla_r8
-        elif opcode <= 0x2f:
-            jumpt[opcode] = sra_r8
-        elif opcode <= 0x37:
-            jumpt[opcode] = swap_r8
-        elif opcode <= 0x3f:
-            jumpt[opcode] = srl_r8
+        r8_index = opcode & 0b00000111
+        b3 = (opcode & 0b00111000) >> 3
+
+        if opcode <= 0x3f:
+            # rlc, rrc, rl, rr, sla, sra, swap, srl, in opcode order
+            jumpt[opcode] = shift_r8(shift_tables[b3], r8_index, b3 in [2, 3])
         elif opcode <= 0x7f:
-            jumpt[opcode] = bit
+            jumpt[opcode] = bit(b3, r8_index)
         elif opcode <= 0xbf:
-            jumpt[opcode] = res
+            jumpt[opcode] = res(b3, r8_index)
         elif opcode <= 0xff:
-            jumpt[opcode] = set
+            jumpt[opcode] = set(b3, r8_index)
     return jumpt
 
 
 
 def execute_instruction():
-    global imm8, imm16, condition, dest_source_r16mem, operand_r16, operand_r8, operand_stk_r16, operand_stk_r8, b3, tgt3
-    opcode = memory[registers.pc]
-    imm8 = memory[registers.pc + 1]
-    imm16 = (memory[registers.pc + 2] << 8) + memory[registers.pc+1]
-
-    condition = cond[(opcode & 0b00011000) >> 3]
-
-    dest_source_r16mem = r16mem[(opcode & 0b00110000) >> 4]
-
-    if opcode != 0xcb:
-        operand_r8 = r8[opcode & 0b00000111]
+    return jump_table[memory.mem[registers.pc]]()
+
+
+def idle():
+    if registers.halt_bug:
+        # The next instruction runs as if it started one byte earlier, its first operand is its opcode
+        registers.halt_bug = False
+        registers.halted = False
+        pc = registers.pc
+        registers.pc = pc - 1
+        post_execution(jump_table[memory.mem[pc]]())
+        return
+    # Nothing runs while halted, so the clock jumps straight to the next event that could wake the CPU
+    if registers.stopped:
+        waking = memory.mem[0xff0f] & 16
     else:
-        operand_r8 = r8[imm8 & 0b00000111]
-    operand_r16 = r16[(opcode & 0b00110000) >> 4]
-    operand_stk_r8 = r8[(opcode & 0b00111000) >> 3]
-    operand_stk_r16 = r16stk[(opcode & 0b00110000) >> 4]
-
-
-    tgt3 = rst_vec[(opcode & 0b00111000) >> 3]
-
-    return jump_table[opcode]()
+        waking = memory.pending
+    if waking != 0:
+        registers.halted = False
+        registers.stopped = False
+        return
+    post_execution(clock.cycles_to_next_event())
 
 
 def run_interrupt():
-    if (memory[0xffff] & memory[0xff0f]) != 0:
-        # vblank interrupt
-        if (memory[0xffff] & 1) == 1 and (memory[0xff0f] & 1) == 1:
-            memory[0xff0f] &= 0b11111110
-            registers.ime = 0
-            vblank_interrupt()
-            clock.add_tick(20)
-        # LCD interrupt
-        elif (memory[0xffff] & 0b10) == 2 and (memory[0xff0f] & 0b10) == 2:
-            memory[0xff0f] &= 0b11111101
-            registers.ime = 0
-            lcd_interrupt()
-            clock.add_tick(20)
-        # Timer interrupt
-        elif (memory[0xffff] & 0b100) == 4 and (memory[0xff0f] & 0b100) == 4:
-            memory[0xff0f] &= 0b11111011
-            registers.ime = 0
-            timer_interrupt()
-            clock.add_tick(20)
-        # Serial interrupt
-        elif (memory[0xffff] & 0b1000) == 8 and (memory[0xff0f] & 0b1000) == 8:
-            memory[0xff0f] &= 0b11110111
-            registers.ime = 0
-            serial_interrupt()
-            clock.add_tick(20)
-        # Joypad interrupt
-        elif (memory[0xffff] & 0b10000) == 16 and (memory[0xff0f] & 0b10000) == 16:
-            memory[0xff0f] &= 0b11101111
-            registers.ime = 0
-            joypad_interrupt()
-            clock.add_tick(20)
-
-def vblank_interrupt():
-    registers["sp"] -= 1
-    registers["sp"] &= 65535
-    memory[registers["sp"]] = registers.pc >> 8
-    registers["sp"] -= 1
-    registers["sp"] &= 65535
-    memory[registers["sp"]] = registers.pc & 255
-    registers.pc = 0x40
-
-def lcd_interrupt():
-    registers["sp"] -= 1
-    registers["sp"] &= 65535
-    memory[registers["sp"]] = registers.pc >> 8
-    registers["sp"] -= 1
-    registers["sp"] &= 65535
-    memory[registers["sp"]] = registers.pc & 255
-    registers.pc = 0x48
-
-def timer_interrupt():
-    registers["sp"] -= 1
-    registers["sp"] &= 65535
-    memory[registers["sp"]] = registers.pc >> 8
-    registers["sp"] -= 1
-    registers["sp"] &= 65535
-    memory[registers["sp"]] = registers.pc & 255
-    registers.pc = 0x50
-
-def serial_interrupt():
-    registers["sp"] -= 1
-    registers["sp"] &= 65535
-    memory[registers["sp"]] = registers.pc >> 8
-    registers["sp"] -= 1
-    registers["sp"] &= 65535
-    memory[registers["sp"]] = registers.pc & 255
-    registers.pc = 0x58
-
-def joypad_interrupt():
-    registers["sp"] -= 1
-    registers["sp"] &= 65535
-    memory[registers["sp"]] = registers.pc >> 8
-    registers["sp"] -= 1
-    registers["sp"] &= 65535
-    memory[registers["sp"]] = registers.pc & 255
-    registers.pc = 0x60
-
-def dma_transfer():
-    to_transfer = memory[0xff46] << 8
-    for i in range(160):
-        memory[0xfe00 + i] = memory[to_transfer + i]
+    pending = memory.pending
+    if pending != 0:
+        vector, bit = interrupt_table[pending]
+        memory[0xff0f] = memory.mem[0xff0f] & ~bit
+        registers.ime = 0
+        push_word(registers.pc)
+        registers.pc = vector
+        clock.add_tick(20)
 
 def post_execution(ticks : int):
     clock.add_tick(ticks)
@@ -1105,12 +1581,6 @@ def post_execution(ticks : int):
     elif registers.ime_to_be_setted == 2:
         registers.ime_to_be_setted = 0
         registers.ime = 1
-    if registers.dma_transfer:
-        registers.dma_transfer = False
-        dma_transfer()
-        clock.add_tick(640)
-    if cartridge.game.is_switched_rom:
-        cartridge.game.switch_bank()
 
 jump_table = generate_table()
 jump_table_cb = generate_table_cb()
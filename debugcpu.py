@@ -70,5 +70,12 @@ class Memory:
         if 0x0000 <= key <= 0xffff:
             self.mem[key] = value
 
+    def read_io(self, key) -> int:
+        return self.mem[key]
+
+    @property
+    def pending(self) -> int:
+        return self.mem[0xffff] & self.mem[0xff0f] & 31
+
     def reset(self) -> None:
         self.mem = [0 for _ in range(2 ** 16)]
@@ -0,0 +1,96 @@
+import time
+import argparse
+import cpu
+import ppu
+import cartridge
+import recompiler
+
+# T-states in a single DMG frame (154 lines * 456 T-states)
+frame_t_states = 70224
+
+
+class RunResult:
+    def __init__(self, display, registers, t_states, elapsed):
+        self.display = display
+        self.registers = registers
+        self.t_states = t_states
+        self.elapsed = elapsed
+
+    def cycles_per_second(self) -> float:
+        if self.elapsed == 0:
+            return 0.0
+        return self.t_states / self.elapsed
+
+    def frames(self) -> float:
+        return self.t_states / frame_t_states
+
+
+def load(romfile: str, save_ram: bool = False) -> ppu.Renderer:
+    # Every call starts from power-on, not from where the previous ROM stopped
+    cpu.reset()
+    # Translated blocks are keyed by bank and address, they belong to the previous ROM
+    recompiler.clear()
+    # Headless runs leave the .sav file alone unless asked to
+    cartridge.game = cartridge.Cartridge(romfile, save_ram)
+    cartridge.game.load_rom()
+    cpu.memory[0xff00] = 0xff
+    return ppu.Renderer()
+
+
+def run(romfile: str, frames: int = 60, cycles: int = None, save_ram: bool = False, recompile: bool = False) -> RunResult:
+    renderer = load(romfile, save_ram)
+
+    if cycles is None:
+        cycles = frames * frame_t_states
+
+    execute = recompiler.execute if recompile else cpu.execute
+    clock = cpu.clock
+    mem = cpu.memory.mem
+    start_t_states = clock.t_states
+    target = start_t_states + cycles
+
+    start = time.perf_counter()
+    while clock.t_states < target:
+        # No buttons are ever pressed on a headless run
+        mem[0xff00] |= 0xcf
+        execute()
+    elapsed = time.perf_counter() - start
+    cartridge.game.flush()
+
+    registers = {
+        "af": cpu.registers.af,
+        "bc": cpu.registers.bc,
+        "de": cpu.registers.de,
+        "hl": cpu.registers.hl,
+        "sp": cpu.registers.sp,
+        "pc": cpu.registers.pc,
+    }
+    return RunResult(renderer.frame.copy(), registers, clock.t_states - start_t_states, elapsed)
+
+
+def dump_ppm(result: RunResult, path: str) -> None:
+    rgb = ppu.Renderer.palette[result.display].astype("uint8")
+    with open(path, "wb") as f:
+        f.write(b"P6\n160 144\n255\n")
+        f.write(rgb.tobytes())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a ROM without opening a window")
+    parser.add_argument("rom")
+    parser.add_argument("-f", "--frames", type=int, default=60, help="number of frames to emulate")
+    parser.add_argument("-c", "--cycles", type=int, help="number of T-states to emulate (overrides --frames)")
+    parser.add_argument("-o", "--dump-frame", help="write the last frame to this file as a PPM image")
+    parser.add_argument("-s", "--save", action="store_true", help="keep battery backed RAM in the .sav file")
+    parser.add_argument("-r", "--recompile", action="store_true", help="run translated basic blocks instead of single instructions")
+    args = parser.parse_args()
+
+    result = run(args.rom, args.frames, args.cycles, args.save, args.recompile)
+
+    print(cpu.registers, end="")
+    print("T-states", result.t_states)
+    print("Frames", round(result.frames(), 2))
+    print("Elapsed", round(result.elapsed, 3), "s")
+    print("Cycles per second", int(result.cycles_per_second()))
+    if args.dump_frame is not None:
+        dump_ppm(result, args.dump_frame)
@@ -1,52 +1,109 @@
 import os
-import sys
+import time
+import argparse
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
 import pygame
 import ppu
 import cpu
 import cartridge
 import joypad
+import recompiler
+import savestate
 
 
 scaling_fact = 4
+# DMG refresh rate (4194304 Hz / 70224 T-states per frame)
+frame_rate = 59.7275
+# In turbo mode a frame is only presented when the host display can show it
+host_refresh_rate = 60
+# Battery backed RAM is written back to the .sav file about once a minute
+flush_interval = 3600
+# Quick save and quick load, the state is kept in <rom>.state
+quick_save_key = pygame.K_F5
+quick_load_key = pygame.K_F8
+
+
+def handle_events(p1, state_file) -> bool:
+    for ev in pygame.event.get():
+        if ev.type == pygame.QUIT:
+            return True
+        if ev.type == pygame.KEYDOWN:
+            if ev.key == quick_save_key:
+                savestate.save_file(state_file)
+                print("State saved to", state_file)
+            elif ev.key == quick_load_key:
+                try:
+                    savestate.load_file(state_file)
+                    print("State loaded from", state_file)
+                except (OSError, ValueError) as e:
+                    print("Cannot load state:", e)
+            for button in p1.buttonskeys:
+                if ev.key == p1.buttonskeys[button]:
+                    cpu.memory[0xff0f] |= 16
+                    p1.buttons[button] = 1
+        if ev.type == pygame.KEYUP:
+            for button in p1.buttonskeys:
+                if ev.key == p1.buttonskeys[button]:
+                    p1.buttons[button] = 0
+    return False
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SillyGB")
+    parser.add_argument("rom")
+    parser.add_argument("-k", "--frame-skip", type=int, default=1, help="render 1 of every K emulated frames")
+    parser.add_argument("-t", "--turbo", action="store_true", help="run unthrottled")
+    parser.add_argument("-r", "--recompile", action="store_true", help="run translated basic blocks instead of single instructions")
+    args = parser.parse_args()
+
     # Initialize display
-    screen = ppu.Display(4)
+    screen = ppu.Display(scaling_fact)
 
     # Load cartridge to memory
-    cartridge.game = cartridge.Cartridge(sys.argv[1])
+    cartridge.game = cartridge.Cartridge(args.rom)
+    print("Title", cartridge.game.header.title)
     print("Rom type", cartridge.game.romtype)
     print("Rom size", cartridge.game.romsize)
     print("Number of banks", cartridge.game.banks_num)
+    if not cartridge.game.header.header_checksum_ok:
+        print("Warning: wrong header checksum")
     cartridge.game.load_rom()
 
     # Initialize joypad
     p1 = joypad.Joypad()
     cpu.memory[0xff00] = 0xff
 
-    tick = 1
+    frame_skip = max(args.frame_skip, 1)
+    pacer = pygame.time.Clock()
+    next_present = 0.0
+
+    execute = recompiler.execute if args.recompile else cpu.execute
+    state_file = savestate.state_path(args.rom)
+    clock = cpu.clock
+    last_frame = clock.frames
     done = False
     while not done:
         cpu.memory[0xff00] = p1.encode_buttons(cpu.memory[0xff00])
-        cpu.execute()
-
-        if tick % 18240 == 0:
-            screen.visualize_display()
-            eventlist = pygame.event.get()
-            for ev in eventlist:
-                if ev.type == pygame.QUIT:
-                    done = True
-                if ev.type == pygame.KEYDOWN:
-                    for button in p1.buttonskeys:
-                        if ev.key == p1.buttonskeys[button]:
-                            cpu.memory[0xff0f] |= 16
-                            p1.buttons[button] = 1
-                if ev.type == pygame.KEYUP:
-                    for button in p1.buttonskeys:
-                        if ev.key == p1.buttonskeys[button]:
-                            p1.buttons[button] = 0
-
-        tick += 1
-
-    pygame.quit()
\ No newline at end of file
+        execute()
+
+        # A new frame starts every time LY reaches 144 (VBlank)
+        if clock.frames != last_frame:
+            last_frame = clock.frames
+            done = handle_events(p1, state_file)
+            if last_frame % flush_interval == 0:
+                cartridge.game.flush()
+
+            # The renderer draws lines as they are emulated, so decide now if the next frame is drawn
+            if args.turbo:
+                if screen.render:
+                    screen.visualize_display()
+                    next_present = time.perf_counter() + 1 / host_refresh_rate
+                screen.render = time.perf_counter() >= next_present
+            else:
+                if screen.render:
+                    screen.visualize_display()
+                screen.render = (last_frame + 1) % frame_skip == 0
+                pacer.tick(frame_rate)
+
+    cartridge.game.flush()
+    pygame.quit()
@@ -1,143 +1,223 @@
-import pygame
 import numpy
 import cpu
 
-class Display:
-    display = numpy.zeros((144, 160), dtype=numpy.uint8, order='C')
-    background = numpy.zeros((256, 256), dtype=numpy.uint8)
-    window = numpy.zeros((256, 256), dtype=numpy.uint8)
-    palette = numpy.array([[185, 237, 186], [118, 196, 123], [49, 105, 64], [10, 38, 16]])
-    bg_palette = [0, 1, 2, 3]
-    obp0 = [0, 1, 2, 3]
-    obp1 = [0, 1, 2, 3]
 
-    def __init__(self, scaling_fact):
-        pygame.init()
-        self.scaling_fact = scaling_fact
-        self.win = pygame.display.set_mode((160 * scaling_fact, 144 * scaling_fact))
-        self.screen = pygame.Surface((160, 144))
-        pygame.display.set_caption("SillyGB")
-        cpu.memory[0xff44] = 0x90
-
-    def visualize_display(self):
-        self.load_display()
-        self.screen = pygame.surfarray.make_surface(self.palette[numpy.transpose(self.display)])
-        self.win.blit(pygame.transform.scale(self.screen, self.win.get_rect().size), (0, 0))
-        pygame.display.update()
+def decode_tiles(raw):
+    # raw holds 16 bytes per tile, two bit planes per row
+    planes = numpy.unpackbits(raw.reshape(-1, 8, 2), axis=2)
+    return planes[:, :, 0:8] | (planes[:, :, 8:16] << 1)
 
-    def decode_tile(self, addr: int):
-        tile = cpu.memory[addr:addr+16]
-        decoded_tile = [[0 for _ in range(8)] for _ in range(8)]
 
-        for y in range(8):
-            byte1 = tile[y * 2]
-            byte2 = tile[y * 2 + 1]
+# Background columns seen by the 160 screen pixels for every SCX value
+scroll_columns = (numpy.arange(256)[:, None] + numpy.arange(160)) & 255
+# BG line seen by the sprites while LCDC bit 0 turns BG and window off
+blank_line = numpy.zeros(160, dtype=numpy.uint8)
 
-            for x in range(8):
-                bit1 = (byte1 >> (7 - x)) & 1
-                bit2 = (byte2 >> (7 - x)) & 1
-                decoded_tile[y][x] = (bit2 << 1) | bit1
 
-        return decoded_tile
+class Renderer:
+    display = numpy.zeros((144, 160), dtype=numpy.uint8, order='C')
+    # Last complete frame, copied from display at the start of VBlank
+    frame = numpy.zeros((144, 160), dtype=numpy.uint8)
+    # Lines are only rendered while this is set, so skipped frames cost nothing
+    render = True
+    window = numpy.zeros((256, 256), dtype=numpy.uint8)
+    palette = numpy.array([[185, 237, 186], [118, 196, 123], [49, 105, 64], [10, 38, 16]])
+    # Sprites on each line, rebuilt by sort_sprites
+    line_sprites = [[] for _ in range(144)]
+    sprites_size = None
+    # One sprite line, indexed by OAM X so the 8 pixels on each side are off screen
+    sprite_colors = numpy.zeros(264, dtype=numpy.uint8)
+    sprite_shades = numpy.zeros(264, dtype=numpy.uint8)
+    sprite_behind = numpy.zeros(264, dtype=bool)
+    # Decoded tiles from 0x8000-0x97ff, refreshed only for tiles written since the last frame
+    tiles = numpy.zeros((384, 8, 8), dtype=numpy.uint8)
+    tiles_version = 0
+    line_tiles_key = None
+    bg_tiles = None
+    palette_luts = {}
+    window_key = None
+    # Window row drawn on the next line that shows the window
+    window_line = 0
+
+    def __init__(self):
+        cpu.memory[0xff44] = 0x90
+        cpu.clock.renderer = self
+
+    def rgb_display(self):
+        return self.palette[self.frame]
+
+    def update_tiles(self):
+        memory = cpu.memory
+        if not memory.vram_dirty:
+            return
+        memory.vram_dirty = False
+        dirty = numpy.flatnonzero(numpy.frombuffer(memory.dirty_tiles, dtype=numpy.uint8))
+        memory.dirty_tiles[:] = bytes(384)
+        vram = numpy.array(memory.mem[0x8000:0x9800], dtype=numpy.uint8).reshape(384, 16)
+        self.tiles[dirty] = decode_tiles(vram[dirty])
+        self.tiles_version += 1
 
     def get_tiles(self):
-        tiles = []
+        self.update_tiles()
         if (cpu.memory[0xff40] & 16) != 0:
-            i = 0x8000
-            while i < 0x8800:
-                tiles.append(self.decode_tile(i))
-                i += 0x0010
-        else:
-            i = 0x9000
-            while i < 0x9800:
-                tiles.append(self.decode_tile(i))
-                i += 0x0010
-        i = 0x8800
-        while i < 0x9000:
-            tiles.append(self.decode_tile(i))
-            i += 0x0010
-
-        return tiles
-
-    def load_background(self):
-        tiles = self.get_tiles()
-        if (cpu.memory[0xff40] & 8) == 0:
-            bg_tiles = cpu.memory[0x9800:0x9c00]
-        else:
-            bg_tiles = cpu.memory[0x9c00:0xa000]
-
-        ti = 0
-        for y in range(32):
-            display_y = y << 3
-            for x in range(32):
-                display_x = x << 3
-                tile = tiles[bg_tiles[y * 32 + x]]
-                for y1 in range(8):
-                    for x1 in range(8):
-                        self.background[display_y + y1, display_x + x1] = self.bg_palette[tile[y1][x1]]
-                ti += 1
+            return self.tiles[0:256]
+        return numpy.concatenate((self.tiles[256:384], self.tiles[128:256]))
+
+    def tile_map(self, tiles, base: int):
+        # Gather the 32x32 tile map into a 256x256 array of colour indices
+        indices = numpy.frombuffer(bytes(cpu.memory.mem[base:base + 0x400]), dtype=numpy.uint8).reshape(32, 32)
+        return tiles.take(indices, 0).transpose(0, 2, 1, 3).reshape(256, 256)
 
     def load_window(self):
-        tiles = self.get_tiles()
-        if (cpu.memory[0xff40] & 64) == 0:
-            wn_tiles = cpu.memory[0x9800:0x9c00]
-        else:
-            wn_tiles = cpu.memory[0x9c00:0xa000]
-
-        ti = 0
-        for y in range(32):
-            display_y = y << 3
-            for x in range(32):
-                display_x = x << 3
-                tile = tiles[wn_tiles[y * 32 + x]]
-                for y1 in range(8):
-                    for x1 in range(8):
-                        self.window[display_y + y1, display_x + x1] = tile[y1][x1]
-                ti += 1
+        # The window is only recomposed when its tile map or tile data changed
+        memory = cpu.memory
+        lcdc = memory[0xff40]
+        tiles = self.line_tiles(lcdc)
+        map_select = (lcdc >> 6) & 1
+        key = (self.line_tiles_key, map_select, memory.tile_map_versions[map_select])
+        if key != self.window_key:
+            self.window_key = key
+            self.window[:] = self.tile_map(tiles, 0x9c00 if map_select != 0 else 0x9800)
 
     def load_sprites(self):
-        oam = cpu.memory[0xfe00:0xfea0]
+        oam = cpu.memory.mem[0xfe00:0xfea0]
         return [oam[i:i + 4] for i in range(0, 160, 4)]
 
-    def load_display(self):
-        self.background.fill(0)
-        if cpu.memory[0xff40] & 1 != 0:
-            bg_pal = cpu.memory[0xff47]
-            self.bg_palette = [(bg_pal & 3), ((bg_pal & 12) >> 2), ((bg_pal & 48) >> 4), (bg_pal >> 6)]
-            self.load_background()
-
-        # Load on display
-        if cpu.memory[0xff40] & 128 != 0:
-            scy = cpu.memory[0xff42]
-            scx = cpu.memory[0xff43]
-            wy = cpu.memory[0xff4a]
-            wx = cpu.memory[0xff4b]
-            for y in range(144):
-                bgy = (y + scy) & 255
-                for x in range(160):
-                    self.display[y, x] = self.background[bgy, (x + scx) & 255]
-            if cpu.memory[0xff40] & 2 != 0:
-                for sprites in self.load_sprites():
-                    if 16 <= sprites[0] <= 159 and 8 <= sprites[1] <= 159:
-                        obp0 = cpu.memory[0xff48]
-                        obp1 = cpu.memory[0xff49]
-                        sprite_tile = numpy.array(self.decode_tile(0x8000 | (sprites[2] << 4)))
-                        # Y flip
-                        if (sprites[3] >> 6) & 1 != 0:
-                            sprite_tile = numpy.flipud(sprite_tile)
-                        # X flip
-                        if (sprites[3] >> 5) & 1 != 0:
-                            sprite_tile = numpy.fliplr(sprite_tile)
-
-                        # Palette
-                        if (sprites[3] >> 4) & 1 != 0:
-                            s_pal = [(obp1 & 3), ((obp1 & 12) >> 2), ((obp1 & 48) >> 4), (obp1 >> 6)]
-                        else:
-                            s_pal = [(obp0 & 3), ((obp0 & 12) >> 2), ((obp0 & 48) >> 4), (obp0 >> 6)]
-
-                        for y in range(8):
-                            for x in range(8):
-                                if sprite_tile[y][x] != 0:
-                                    self.display[sprites[0] + y - 16, sprites[1] + x - 8] = s_pal[sprite_tile[y][x]]
+    def sort_sprites(self, lcdc: int):
+        # Bucket the sprites by line, at most 10 per line in OAM order, only when OAM or the sprite size changed
+        memory = cpu.memory
+        if not memory.oam_dirty and (lcdc & 4) == self.sprites_size:
+            return
+        memory.oam_dirty = False
+        self.sprites_size = lcdc & 4
+        height = 16 if lcdc & 4 != 0 else 8
+        lines = [[] for _ in range(144)]
+        for sprite in self.load_sprites():
+            top = sprite[0] - 16
+            for ly in range(max(top, 0), min(top + height, 144)):
+                if len(lines[ly]) < 10:
+                    lines[ly].append(sprite)
+        # Draw order is lowest priority first: higher X first, then higher OAM index
+        self.line_sprites = [sorted(reversed(line), key=lambda sprite: sprite[1], reverse=True) for line in lines]
+
+    def line_tiles(self, lcdc: int):
+        # Background tiles for the tile data area selected in LCDC
+        self.update_tiles()
+        key = (lcdc & 16, self.tiles_version)
+        if key != self.line_tiles_key:
+            self.line_tiles_key = key
+            self.bg_tiles = self.get_tiles()
+        return self.bg_tiles
+
+    def palette_lut(self, value: int):
+        lut = self.palette_luts.get(value)
+        if lut is None:
+            lut = numpy.array([(value & 3), ((value & 12) >> 2), ((value & 48) >> 4), (value >> 6)], dtype=numpy.uint8)
+            self.palette_luts[value] = lut
+        return lut
+
+    def render_line(self, ly: int):
+        if not self.render:
+            return
+        mem = cpu.memory.mem
+        lcdc = mem[0xff40]
+        if lcdc & 128 == 0:
+            self.display[ly].fill(0)
+            return
+
+        if lcdc & 1 == 0:
+            # BG and window are blank (colour 0), sprites are still drawn over them
+            line = blank_line
+            self.display[ly].fill(0)
+        else:
+            tiles = self.line_tiles(lcdc)
+            y = (ly + mem[0xff42]) & 255
+            row_addr = (0x9c00 if lcdc & 8 != 0 else 0x9800) + ((y >> 3) << 5)
+            indices = numpy.frombuffer(bytes(mem[row_addr:row_addr + 32]), dtype=numpy.uint8)
+            row = tiles.take(indices, 0)[:, y & 7].reshape(256)
+            line = row.take(scroll_columns[mem[0xff43]])
+
+            wx = mem[0xff4b] - 7
+            if lcdc & 32 != 0 and ly >= mem[0xff4a] and wx < 160:
+                self.load_window()
+                if wx < 0:
+                    line = self.window[self.window_line, -wx:160 - wx]
+                else:
+                    line[wx:160] = self.window[self.window_line, 0:160 - wx]
+                self.window_line += 1
+
+            self.display[ly] = self.palette_lut(mem[0xff47]).take(line)
+
+        if lcdc & 2 != 0:
+            self.sort_sprites(lcdc)
+            if self.line_sprites[ly]:
+                self.render_sprites(ly, lcdc, line)
+
+    def render_sprites(self, ly: int, lcdc: int, line):
+        # The BG path refreshes the tile cache too, but not while BG is off
+        self.update_tiles()
+        mem = cpu.memory.mem
+        tiles = self.tiles
+        colors = self.sprite_colors
+        shades = self.sprite_shades
+        behind = self.sprite_behind
+        colors.fill(0)
+        for sprite in self.line_sprites[ly]:
+            y, x, tile, attr = sprite
+            row = ly - y + 16
+            if lcdc & 4 != 0:
+                tile &= 0xfe
+                if attr & 64 != 0:
+                    row = 15 - row
+                tile += row >> 3
+                row &= 7
+            elif attr & 64 != 0:
+                row = 7 - row
+            pixels = tiles[tile, row]
+            if attr & 32 != 0:
+                pixels = pixels[::-1]
+
+            # Pixels of later (higher priority) sprites replace the ones already drawn
+            opaque = pixels != 0
+            obp = mem[0xff49] if attr & 16 != 0 else mem[0xff48]
+            numpy.copyto(colors[x:x + 8], pixels, where=opaque)
+            numpy.copyto(shades[x:x + 8], self.palette_lut(obp).take(pixels), where=opaque)
+            behind[x:x + 8][opaque] = attr & 128 != 0
+
+        # Buffers are offset by 8 so sprites hanging off either edge are clipped by the slice
+        visible = (colors[8:168] != 0) & (~behind[8:168] | (line == 0))
+        numpy.copyto(self.display[ly], shades[8:168], where=visible)
+
+    def end_frame(self):
+        self.window_line = 0
+        if not self.render:
+            return
+        self.frame[:] = self.display
 
+    def load_display(self):
+        # Whole frame snapshot of the current state, the emulation loop renders line by line instead
+        render = self.render
+        self.render = True
+        self.window_line = 0
+        for ly in range(144):
+            self.render_line(ly)
+        self.end_frame()
+        self.render = render
+
+
+class Display(Renderer):
+    # pygame is only imported here so that headless runs never pay for it
+    def __init__(self, scaling_fact):
+        import pygame
+        super().__init__()
+        pygame.init()
+        self.scaling_fact = scaling_fact
+        self.win = pygame.display.set_mode((160 * scaling_fact, 144 * scaling_fact))
+        self.screen = pygame.Surface((160, 144))
+        pygame.display.set_caption("SillyGB")
 
+    def visualize_display(self):
+        import pygame
+        self.screen = pygame.surfarray.make_surface(self.palette[numpy.transpose(self.frame)])
+        self.win.blit(pygame.transform.scale(self.screen, self.win.get_rect().size), (0, 0))
+        pygame.display.update()
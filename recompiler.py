@@ -0,0 +1,204 @@
+import cpu
+
+# Longest run of instructions translated into a single block
+max_block_length = 32
+
+# Instruction length in bytes for each opcode
+lengths = [1 for _ in range(256)]
+for opcode in [0x06, 0x0e, 0x16, 0x1e, 0x26, 0x2e, 0x36, 0x3e, 0x10, 0x18, 0x20, 0x28, 0x30, 0x38,
+               0xc6, 0xce, 0xd6, 0xde, 0xe6, 0xee, 0xf6, 0xfe, 0xe0, 0xf0, 0xe8, 0xf8, 0xcb]:
+    lengths[opcode] = 2
+for opcode in [0x01, 0x11, 0x21, 0x31, 0x08, 0xc2, 0xc3, 0xc4, 0xca, 0xcc, 0xcd, 0xd2, 0xd4, 0xda, 0xdc, 0xea, 0xfa]:
+    lengths[opcode] = 3
+
+# Jumps, calls, returns, HALT, STOP and EI end a block, their handler decides where execution goes on
+terminators = [0x10, 0x18, 0x20, 0x28, 0x30, 0x38, 0x76, 0xc0, 0xc2, 0xc3, 0xc4, 0xc7, 0xc8, 0xc9, 0xca, 0xcc,
+               0xcd, 0xcf, 0xd0, 0xd2, 0xd4, 0xd7, 0xd8, 0xd9, 0xda, 0xdc, 0xdf, 0xe7, 0xe9, 0xef, 0xf7, 0xfb, 0xff]
+invalid_opcodes = [0xd3, 0xdb, 0xdd, 0xe3, 0xe4, 0xeb, 0xec, 0xed, 0xf4, 0xfc, 0xfd]
+
+# T-states of every instruction that is not a terminator, summed when a block is translated
+cycles = [4 for _ in range(256)]
+for opcode in range(256):
+    if opcode in [0x01, 0x11, 0x21, 0x31, 0xc1, 0xd1, 0xe1, 0xf1, 0xe0, 0xf0, 0xf8, 0x34, 0x35, 0x36]:
+        cycles[opcode] = 12
+    elif opcode in [0xc5, 0xd5, 0xe5, 0xf5, 0xe8, 0xea, 0xfa]:
+        cycles[opcode] = 16
+    elif opcode == 0x08:
+        cycles[opcode] = 20
+    elif opcode & 0xc7 == 0x06 or opcode & 0xc7 == 0xc6 or opcode in [0xe2, 0xf2, 0xf9]:
+        cycles[opcode] = 8
+    elif opcode < 0x40 and opcode & 0x07 in [0x02, 0x03] or opcode < 0x40 and opcode & 0x0f in [0x09, 0x0a, 0x0b]:
+        cycles[opcode] = 8
+    elif 0x40 <= opcode <= 0xbf and (opcode & 7 == 6 or 0x70 <= opcode <= 0x77):
+        cycles[opcode] = 8
+cycles_cb = [(8 if opcode & 7 != 6 else 12 if 0x40 <= opcode <= 0x7f else 16) for opcode in range(256)]
+
+r8 = ["b", "c", "d", "e", "h", "l", None, "a"]
+r16_pairs = [("b", "c"), ("d", "e"), ("h", "l")]
+hl = "(registers.h << 8) | registers.l"
+
+# Translated blocks in ROM, keyed by (bank << 16) | address, they stay valid for the whole run
+rom_blocks = {}
+# Blocks in RAM, keyed by address, with the code bytes they were translated from
+ram_blocks = {}
+
+
+def inline(opcode, operand):
+    # Source for the instructions simple enough to be written out, None when the handler is called instead
+    if opcode == 0x00:
+        return []
+    if 0x40 <= opcode <= 0x7f and opcode != 0x76:
+        dest = r8[(opcode >> 3) & 7]
+        source = r8[opcode & 7]
+        if source is None:
+            return ["registers." + dest + " = read_hl()"]
+        if dest is None:
+            return ["memory[" + hl + "] = registers." + source]
+        if dest == source:
+            return []
+        return ["registers." + dest + " = registers." + source]
+    if opcode & 0xc7 == 0x06:
+        dest = r8[(opcode >> 3) & 7]
+        if dest is None:
+            return ["memory[" + hl + "] = " + hex(operand)]
+        return ["registers." + dest + " = " + hex(operand)]
+    if opcode in [0x01, 0x11, 0x21]:
+        high, low = r16_pairs[opcode >> 4]
+        return ["registers." + high + " = " + hex(operand >> 8), "registers." + low + " = " + hex(operand & 255)]
+    if opcode == 0x31:
+        return ["registers.sp = " + hex(operand)]
+    if opcode in [0x03, 0x13, 0x23, 0x33, 0x0b, 0x1b, 0x2b, 0x3b]:
+        name = ["bc", "de", "hl", "sp"][opcode >> 4]
+        step = " + 1" if opcode & 8 == 0 else " - 1"
+        return ["registers." + name + " = (registers." + name + step + ") & 65535"]
+    if opcode in [0x02, 0x12]:
+        high, low = r16_pairs[opcode >> 4]
+        return ["memory[(registers." + high + " << 8) | registers." + low + "] = registers.a"]
+    if opcode in [0x0a, 0x1a]:
+        high, low = r16_pairs[opcode >> 4]
+        return ["registers.a = read((registers." + high + " << 8) | registers." + low + ")"]
+    if opcode == 0xea:
+        return ["memory[" + hex(operand) + "] = registers.a"]
+    if opcode == 0xfa:
+        if operand >= 0xff00:
+            return ["registers.a = memory.read_io(" + hex(operand) + ")"]
+        return ["registers.a = mem[" + hex(operand) + "]"]
+    if opcode == 0xe0:
+        return ["memory[" + hex(0xff00 + operand) + "] = registers.a"]
+    if opcode == 0xf0:
+        return ["registers.a = memory.read_io(" + hex(0xff00 + operand) + ")"]
+    return None
+
+
+def translate(start: int):
+    # Follow the code from start up to a terminator and build one function running all of it
+    mem = cpu.memory.mem
+    # ROM blocks never run into the next 16 KiB bank, it may be switched by the time they get there
+    limit = (start & 0xc000) + 0x4000 if start < 0x8000 else 0x10000
+    body = []
+    handlers = []
+    total = 0
+    pc = start
+    # Handlers read their operands at registers.pc, inlined instructions do not move it
+    pc_synced = True
+    terminated = False
+    for _ in range(max_block_length):
+        opcode = mem[pc]
+        length = lengths[opcode]
+        if pc + length > limit and pc == start:
+            # The operands run into the next region, the handler alone reads them from the bus as it is then
+            return cpu.jump_table[opcode], pc + length
+        if pc + length > limit or (opcode in invalid_opcodes and pc != start):
+            break
+        if opcode in terminators or opcode in invalid_opcodes:
+            if pc == start:
+                # A block made of a single jump is just its handler
+                return cpu.jump_table[opcode], pc + length
+            if not pc_synced:
+                body.append("registers.pc = " + hex(pc))
+            handlers.append(cpu.jump_table[opcode])
+            body.append("return " + str(total) + " + h" + str(len(handlers) - 1) + "()")
+            pc += length
+            terminated = True
+            break
+
+        operand = mem[pc + 1] if length == 2 else mem[pc + 1] | (mem[pc + 2] << 8) if length == 3 else 0
+        source = inline(opcode, operand)
+        if source is not None:
+            body += source
+            pc_synced = False
+        else:
+            if not pc_synced:
+                body.append("registers.pc = " + hex(pc))
+            if opcode == 0xcb:
+                # Skip the prefix dispatch, the CB opcode is known
+                handlers.append(cpu.jump_table_cb[operand])
+            else:
+                handlers.append(cpu.jump_table[opcode])
+            body.append("h" + str(len(handlers) - 1) + "()")
+            pc_synced = True
+        total += cycles_cb[operand] if opcode == 0xcb else cycles[opcode]
+        pc += length
+
+    if not terminated:
+        if not pc_synced:
+            body.append("registers.pc = " + hex(pc))
+        body.append("return " + str(total))
+
+    names = ["h" + str(i) for i in range(len(handlers))]
+    source = "def make(" + ", ".join(names) + "):\n"
+    source += "    def block():\n"
+    source += "        mem = memory.mem\n"
+    for line in body:
+        source += "        " + line + "\n"
+    source += "    return block\n"
+    # Blocks run with the globals of cpu, so memory and registers are looked up as they are there
+    namespace = {}
+    exec(compile(source, "<block " + hex(start) + ">", "exec"), vars(cpu), namespace)
+    return namespace["make"](*handlers), pc
+
+
+def lookup(pc: int):
+    if pc < 0x8000:
+        mapper = cpu.memory.mapper
+        if mapper is None:
+            bank = 0
+        elif pc < 0x4000:
+            bank = mapper.rom0_bank
+        else:
+            bank = mapper.rom_bank
+        key = (bank << 16) | pc
+        block = rom_blocks.get(key)
+        if block is None:
+            block = translate(pc)[0]
+            rom_blocks[key] = block
+        return block
+
+    # Code in RAM can be rewritten at any time, the block is translated again when its bytes changed
+    entry = ram_blocks.get(pc)
+    if entry is None or cpu.memory.mem[pc:entry[1]] != entry[2]:
+        block, end = translate(pc)
+        entry = (block, end, bytes(cpu.memory.mem[pc:end]))
+        ram_blocks[pc] = entry
+    return entry[0]
+
+
+def clear():
+    rom_blocks.clear()
+    ram_blocks.clear()
+
+
+def execute():
+    # Same as cpu.execute, but runs a whole block at a time
+    registers = cpu.registers
+    if registers.halted:
+        cpu.idle()
+        return
+    if cpu.memory.pending != 0 and registers.ime == 1:
+        cpu.run_interrupt()
+    if registers.ime_to_be_setted != 0 or registers.dma_transfer:
+        # The instruction after EI runs alone so IME is set exactly one instruction later,
+        # during OAM DMA blocks translated from ROM would not see the bus reading 0xff
+        cpu.post_execution(cpu.execute_instruction())
+        return
+    cpu.post_execution(lookup(registers.pc)())
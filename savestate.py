@@ -0,0 +1,163 @@
+import os
+import heapq
+import struct
+import numpy
+import cpu
+import cartridge
+
+magic = b"SGBS"
+version = 2
+
+# Magic, version, then the cartridge the state belongs to (global checksum and type)
+header_format = "<4sHHB"
+# a b c d e f h l, sp pc, ime ime_to_be_setted halted stopped halt_bug
+registers_format = "<8BHH5B"
+# t_states frames mode, timer div_base tima_value tima_sync, OAM DMA deadline (0 when none), number of events
+clock_format = "<qqBqHqqH"
+# deadline and kind of each scheduled event, the callback is found again from the kind
+event_format = "<qB"
+# Window line, followed by the line buffer and the last complete frame
+ppu_format = "<H"
+frame_size = 144 * 160
+
+
+def state_path(romfile: str) -> str:
+    # Quick save slot next to the ROM, like the .sav file
+    return os.path.splitext(romfile)[0] + ".state"
+
+
+def event_callbacks():
+    return {
+        cpu.ppu_event: cpu.clock.next_mode,
+        cpu.timer_event: cpu.timer.overflow,
+        cpu.serial_event: cpu.clock.serial_done,
+    }
+
+
+def save() -> bytes:
+    registers = cpu.registers
+    memory = cpu.memory
+    clock = cpu.clock
+    timer = cpu.timer
+    renderer = clock.renderer
+    game = cartridge.game
+
+    bus = bytearray(memory.mem)
+    dma_deadline = 0
+    if registers.dma_transfer:
+        # Saved as the bus the transfer hides, load blocks it again until the same deadline
+        bus[0x0000:0x8000], bus[0xa000:0xfea0] = memory.dma_saved
+        dma_deadline = next(event[0] for event in clock.events if event[1] == cpu.dma_event)
+    events = [event for event in clock.events if event[1] != cpu.dma_event]
+
+    parts = [
+        struct.pack(header_format, magic, version, game.header.global_checksum, game.romtype),
+        struct.pack(registers_format, registers.a, registers.b, registers.c, registers.d, registers.e,
+                    registers.f, registers.h, registers.l, registers.sp, registers.pc,
+                    registers.ime, registers.ime_to_be_setted, registers.halted, registers.stopped,
+                    registers.halt_bug),
+        struct.pack(clock_format, clock.t_states, clock.frames, clock.mode,
+                    timer.div_base, timer.tima_value, timer.tima_sync, dma_deadline, len(events)),
+    ]
+    parts += [struct.pack(event_format, deadline, kind) for deadline, kind, callback in events]
+    parts.append(bytes(bus))
+    parts.append(struct.pack(ppu_format, renderer.window_line))
+    parts.append(renderer.display.tobytes())
+    parts.append(renderer.frame.tobytes())
+    parts.append(game.mapper.save_state())
+    return b"".join(parts)
+
+
+def load(data: bytes):
+    registers = cpu.registers
+    memory = cpu.memory
+    clock = cpu.clock
+    timer = cpu.timer
+    renderer = clock.renderer
+    game = cartridge.game
+
+    # The whole blob is checked and unpacked first, nothing is touched unless it can all be applied
+    try:
+        state_magic, state_version, checksum, romtype = struct.unpack_from(header_format, data)
+        if state_magic != magic or state_version != version:
+            raise ValueError("Not a save state of this version")
+        if checksum != game.header.global_checksum or romtype != game.romtype:
+            raise ValueError("Save state belongs to another cartridge")
+        offset = struct.calcsize(header_format)
+
+        values = struct.unpack_from(registers_format, data, offset)
+        offset += struct.calcsize(registers_format)
+        clock_values = struct.unpack_from(clock_format, data, offset)
+        offset += struct.calcsize(clock_format)
+        dma_deadline, count = clock_values[6:8]
+
+        size = (offset + count * struct.calcsize(event_format) + 0x10000 + struct.calcsize(ppu_format) + 2 * frame_size +
+                game.mapper.state_size())
+        if len(data) != size:
+            raise ValueError("Save state is " + str(len(data)) + " bytes, expected " + str(size))
+
+        callbacks = event_callbacks()
+        events = []
+        for _ in range(count):
+            deadline, kind = struct.unpack_from(event_format, data, offset)
+            offset += struct.calcsize(event_format)
+            if kind not in callbacks:
+                raise ValueError("Unknown event kind " + str(kind) + " in save state")
+            events.append((deadline, kind, callbacks[kind]))
+
+        bus = data[offset:offset + 0x10000]
+        offset += 0x10000
+        window_line = struct.unpack_from(ppu_format, data, offset)[0]
+        offset += struct.calcsize(ppu_format)
+        display = numpy.frombuffer(data, dtype=numpy.uint8, count=frame_size, offset=offset).reshape(144, 160)
+        offset += frame_size
+        frame = numpy.frombuffer(data, dtype=numpy.uint8, count=frame_size, offset=offset).reshape(144, 160)
+        offset += frame_size
+        mapper_state = memoryview(data)[offset:]
+    except struct.error as e:
+        raise ValueError("Corrupt save state: " + str(e))
+
+    registers.a, registers.b, registers.c, registers.d, registers.e, registers.f, registers.h, registers.l = values[0:8]
+    registers.sp, registers.pc, registers.ime, registers.ime_to_be_setted = values[8:12]
+    registers.halted = values[12] != 0
+    registers.stopped = values[13] != 0
+    registers.halt_bug = values[14] != 0
+
+    # A transfer still running puts the real bus and write handlers back before they are replaced
+    if registers.dma_transfer:
+        memory.end_dma(clock.t_states)
+    clock.t_states, clock.frames, clock.mode, timer.div_base, timer.tima_value, timer.tima_sync = clock_values[0:6]
+    clock.events[:] = events
+    heapq.heapify(clock.events)
+    clock.next_event = clock.events[0][0] if clock.events else float("inf")
+
+    memory.mem[:] = bus
+    memory.pending = memory.mem[0xffff] & memory.mem[0xff0f] & 31
+    # Everything the PPU decoded from VRAM and OAM is stale
+    memory.dirty_tiles[:] = b"\x01" * 384
+    memory.vram_dirty = True
+    memory.tile_map_versions[0] += 1
+    memory.tile_map_versions[1] += 1
+    memory.oam_dirty = True
+
+    renderer.window_line = window_line
+    renderer.display[:] = display
+    renderer.frame[:] = frame
+
+    game.mapper.load_state(mapper_state)
+    if dma_deadline != 0:
+        memory.block_bus(dma_deadline)
+
+
+def save_file(path: str):
+    data = save()
+    # Written next to the final file and renamed, so a crash never leaves half a state
+    temp = path + "." + str(os.getpid())
+    with open(temp, 'wb') as f:
+        f.write(data)
+    os.replace(temp, path)
+
+
+def load_file(path: str):
+    with open(path, 'rb') as f:
+        load(f.read())
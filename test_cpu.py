@@ -0,0 +1,15 @@
+import headless
+
+
+def test_halt_bug_without_recursion(tmp_path):
+    # IE and IF set with IME off, then halt; inc a; halt; halt
+    rom = bytearray(0x8000)
+    rom[0x100:0x10b] = bytes([0x3e, 0x01, 0xe0, 0xff, 0xe0, 0x0f, 0xf3, 0x76, 0x3c, 0x76, 0x76])
+    path = tmp_path / "haltbug.gb"
+    path.write_bytes(bytes(rom))
+
+    for recompile in [False, True]:
+        result = headless.run(str(path), frames=1, recompile=recompile)
+        # The byte after the first HALT runs twice, the second HALT then repeats the one after it forever
+        assert result.registers["af"] >> 8 == 3
+        assert result.registers["pc"] == 0x10a
@@ -0,0 +1,33 @@
+import headless
+
+
+def write_rom(path, code):
+    rom = bytearray(0x8000)
+    rom[0x100:0x100 + len(code)] = bytes(code)
+    path.write_bytes(bytes(rom))
+    return str(path)
+
+
+def test_block_straddling_bank_boundary(tmp_path):
+    # ld hl,0x1234 at 0x3ffe has its operands in bank 1, jr $ at 0x4001
+    rom = bytearray(0x8000)
+    rom[0x100:0x104] = bytes([0x00, 0xc3, 0xfe, 0x3f])
+    rom[0x3ffe:0x4001] = bytes([0x21, 0x34, 0x12])
+    rom[0x4001:0x4003] = bytes([0x18, 0xfe])
+    path = tmp_path / "straddle.gb"
+    path.write_bytes(bytes(rom))
+
+    result = headless.run(str(path), frames=1, recompile=True)
+    assert result.registers["hl"] == 0x1234
+    assert result.registers["pc"] == 0x4001
+
+
+def test_blocks_not_reused_by_next_rom(tmp_path):
+    # Same address and bank, different code: ld a,X then jr $
+    first = write_rom(tmp_path / "first.gb", [0x3e, 0x11, 0x18, 0xfe])
+    second = write_rom(tmp_path / "second.gb", [0x3e, 0x22, 0x18, 0xfe])
+
+    headless.run(first, frames=1, recompile=True)
+    result = headless.run(second, frames=1, recompile=True)
+    assert result.registers["af"] >> 8 == 0x22
+    assert result.registers["pc"] == 0x102
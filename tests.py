@@ -1,8 +1,14 @@
 import os
+import sys
+import time
+import argparse
+import concurrent.futures
 import cpu
-import json
-import prettyhex
 import debugcpu
+import testvectors
+
+
+tests_dir = 'GameboyCPUTests/v2/'
 
 
 def set_reg_values(registers, a: int, b: int, c: int, d: int, e: int, f: int, h: int, l: int, pc: int, sp: int) -> None:
@@ -18,53 +24,99 @@ def set_reg_values(registers, a: int, b: int, c: int, d: int, e: int, f: int, h:
     registers['sp'] = sp
 
 
-def set_ram_values(memory, ram_values : list) -> None:
-    memory.reset()
-    for values in ram_values:
-        memory[values[0]] = values[1]
+def init_worker() -> None:
+    # Cases write anywhere in the 64 KiB space, ROM included, so they run on flat memory
+    cpu.memory = debugcpu.Memory()
+    cpu.memory.reset()
+
+
+def run_case(case, addrs, values) -> str:
+    # Returns a description of the first difference, None if the case passed
+    registers = cpu.registers
+    mem = cpu.memory.mem
+
+    a, b, c, d, e, f, h, l, pc, sp = case[0:10]
+    set_reg_values(registers, a, b, c, d, e, f, h, l, pc - 1, sp)
+    registers.ime_to_be_setted = 0
+    registers.halted = False
+    registers.stopped = False
+    registers.halt_bug = False
+    initial_ram, initial_count, final_ram, final_count = case[20:24]
+    for i in range(initial_ram, initial_ram + initial_count):
+        mem[addrs[i]] = values[i]
+
+    cpu.execute_instruction()
+
+    a, b, c, d, e, f, h, l, pc, sp = case[10:20]
+    expected = [(a << 8) | f, (b << 8) | c, (d << 8) | e, (h << 8) | l, sp, pc - 1]
+    got = registers.debug_compare()
+    ram = [(addrs[i], values[i], mem[addrs[i]]) for i in range(final_ram, final_ram + final_count) if mem[addrs[i]] != values[i]]
+
+    # Only the addresses the case touched need to be cleared for the next one
+    for i in range(initial_ram, initial_ram + initial_count):
+        mem[addrs[i]] = 0
+    for i in range(final_ram, final_ram + final_count):
+        mem[addrs[i]] = 0
+
+    if got != expected:
+        names = ["af", "bc", "de", "hl", "sp", "pc"]
+        return "registers " + ", ".join(names[i] + " " + hex(got[i]) + " (expected " + hex(expected[i]) + ")"
+                                        for i in range(6) if got[i] != expected[i])
+    if ram:
+        return "ram " + ", ".join(hex(addr) + " " + hex(value) + " (expected " + hex(expected_value) + ")"
+                                  for addr, expected_value, value in ram)
+    return None
+
+
+def run_file(test_file: str, use_cache: bool = True):
+    # Runs in a worker process, returns (opcode, cases, failed, first failure)
+    if use_cache:
+        cases, ram, names = testvectors.load(tests_dir + test_file)
+    else:
+        cases, ram, names = testvectors.parse(tests_dir + test_file)
+    addrs = ram["addr"].tolist()
+    values = ram["value"].tolist()
+
+    failed = 0
+    first_failure = None
+    for index, case in enumerate(cases.tolist()):
+        failure = run_case(case, addrs, values)
+        if failure is not None:
+            failed += 1
+            if first_failure is None:
+                first_failure = names[index] + " (" + test_file + " case " + str(index) + "): " + failure
+    return os.path.splitext(test_file)[0], len(cases), failed, first_failure
 
 
 if __name__ == "__main__":
-    print("BEFORE RUNNING THE TEST REMEMBER TO CHANGE THE debug VARIABLE IN cpu.py")
-
-    expected_reg = debugcpu.Registers()
-    expected_ram = debugcpu.Memory()
-
-    tests_dir = 'GameboyCPUTests/v2/'
-    tests_files = os.listdir(tests_dir)
-    tests_files.remove("README.md")
+    parser = argparse.ArgumentParser(description="Run the GameboyCPUTests suite")
+    parser.add_argument("opcodes", nargs="*", help="only run these opcodes, e.g. 3e or 'cb 7c'")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--json", action="store_true", help="parse the JSON files instead of using the compiled cache")
+    args = parser.parse_args()
+
+    tests_files = sorted(name for name in os.listdir(tests_dir) if name.endswith(".json"))
+    if args.opcodes:
+        wanted = [opcode.lower() for opcode in args.opcodes]
+        tests_files = [name for name in tests_files if os.path.splitext(name)[0].lower() in wanted]
+
+    start = time.perf_counter()
+    # One opcode file per task, the results come back in opcode order
+    with concurrent.futures.ProcessPoolExecutor(args.jobs, initializer=init_worker) as executor:
+        results = list(executor.map(run_file, tests_files, [not args.json] * len(tests_files)))
+    elapsed = time.perf_counter() - start
 
     passed = 0
-    for test_file in tests_files:
-        json_file = tests_dir + test_file
-        with open(json_file, 'r') as f:
-            failed_reg = 0
-            failed_ram = 0
-
-            tests = json.load(f)
-            for test in tests:
-                name = [int(x, 16) for x in test["name"].split(" ")]
-
-                ini = test["initial"]
-                set_reg_values(cpu.registers, ini["a"], ini["b"], ini["c"], ini["d"], ini["e"], ini["f"], ini["h"], ini["l"], ini["pc"]-1, ini["sp"])
-                set_ram_values(cpu.memory, ini["ram"])
-
-                fin = test["final"]
-                set_reg_values(expected_reg, fin["a"], fin["b"], fin["c"], fin["d"], fin["e"], fin["f"], fin["h"], fin["l"], fin["pc"]-1, fin["sp"])
-                set_ram_values(expected_ram, fin["ram"])
-
-                cpu.execute_instruction()
-
-                if cpu.registers.debug_compare() != expected_reg.debug_compare():
-                    failed_reg += 1
-
-                if cpu.memory.mem != expected_ram.mem:
-                    failed_ram += 1
-
-            if failed_reg == 0 and failed_ram == 0:
-                passed += 1
-                print("opcode " + prettyhex.prettyhex2(name[0]) + ": \033[92mPASSED\033[0m")
-            else:
-                print("opcode " + prettyhex.prettyhex2(name[0]) + ": \033[91mFAILED\033[0m")
-
-    print("Tests passed: " + str(passed) + "/" + str(len(tests_files)))
+    cases = 0
+    for opcode, count, failed, first_failure in results:
+        cases += count
+        if failed == 0:
+            passed += 1
+            print("opcode " + opcode + ": \033[92mPASSED\033[0m")
+        else:
+            print("opcode " + opcode + ": \033[91mFAILED\033[0m " + str(failed) + "/" + str(count) + ", first: " + first_failure)
+
+    print("Tests passed: " + str(passed) + "/" + str(len(results)))
+    print("Cases", cases)
+    print("Elapsed", round(elapsed, 3), "s")
+    sys.exit(0 if passed == len(results) else 1)
@@ -0,0 +1,104 @@
+import os
+import sys
+import json
+import hashlib
+import numpy
+
+# Compiled test vectors live here, one file per opcode, rebuilt whenever the JSON source changes
+cache_dir = '.cache/GameboyCPUTests/'
+magic = b"GBCT"
+version = 2
+
+# Registers before and after each case, then where its RAM pairs start in the ram array and how many there are
+registers = ["a", "b", "c", "d", "e", "f", "h", "l", "pc", "sp"]
+case_dtype = numpy.dtype([("initial_" + name, "<u2") for name in registers] +
+                         [("final_" + name, "<u2") for name in registers] +
+                         [("initial_ram", "<u4"), ("initial_ram_count", "<u2"),
+                          ("final_ram", "<u4"), ("final_ram_count", "<u2")])
+ram_dtype = numpy.dtype([("addr", "<u2"), ("value", "u1")])
+# The digest is raw bytes, an S16 field would drop its trailing NULs. The test names follow the RAM pairs, one per line
+header_dtype = numpy.dtype([("magic", "S4"), ("version", "<u4"), ("digest", "V16"), ("cases", "<u4"), ("ram", "<u4"),
+                            ("names", "<u4")])
+
+
+def source_digest(path: str) -> bytes:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def parse(path: str):
+    # Turn the JSON cases into a case array, one flat array of (addr, value) pairs and the test names
+    with open(path, 'r') as f:
+        tests = json.load(f)
+
+    cases = numpy.zeros(len(tests), dtype=case_dtype)
+    pairs = []
+    for i, test in enumerate(tests):
+        case = cases[i]
+        for state in ["initial", "final"]:
+            values = test[state]
+            for name in registers:
+                case[state + "_" + name] = values[name]
+            case[state + "_ram"] = len(pairs)
+            case[state + "_ram_count"] = len(values["ram"])
+            pairs += values["ram"]
+    ram = numpy.array([tuple(pair) for pair in pairs], dtype=ram_dtype)
+    names = [test["name"] for test in tests]
+    return cases, ram, names
+
+
+def cache_path(path: str) -> str:
+    return cache_dir + os.path.splitext(os.path.basename(path))[0] + ".bin"
+
+
+def convert(path: str, digest: bytes = None):
+    if digest is None:
+        digest = source_digest(path)
+    cases, ram, names = parse(path)
+    names_data = "\n".join(names).encode("utf-8")
+    header = numpy.array([(magic, version, digest, len(cases), len(ram), len(names_data))], dtype=header_dtype)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Written next to the final file and renamed, so a worker never reads half a cache
+    temp = cache_path(path) + "." + str(os.getpid())
+    with open(temp, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(cases.tobytes())
+        f.write(ram.tobytes())
+        f.write(names_data)
+    os.replace(temp, cache_path(path))
+    return cases, ram, names
+
+
+def load(path: str):
+    # Cases, RAM pairs and test names for a JSON test file, from the cache when it was built from the same source
+    digest = source_digest(path)
+    try:
+        with open(cache_path(path), 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return convert(path, digest)
+
+    if len(data) < header_dtype.itemsize:
+        return convert(path, digest)
+    header = numpy.frombuffer(data, dtype=header_dtype, count=1)[0]
+    if header["magic"] != magic or header["version"] != version or bytes(header["digest"]) != digest:
+        return convert(path, digest)
+    offset = header_dtype.itemsize
+    cases = numpy.frombuffer(data, dtype=case_dtype, count=header["cases"], offset=offset)
+    offset += case_dtype.itemsize * int(header["cases"])
+    ram = numpy.frombuffer(data, dtype=ram_dtype, count=header["ram"], offset=offset)
+    offset += ram_dtype.itemsize * int(header["ram"])
+    names = data[offset:offset + int(header["names"])].decode("utf-8").split("\n")
+    return cases, ram, names
+
+
+if __name__ == "__main__":
+    # One time conversion of the whole suite, tests.py also does it on demand
+    tests_dir = sys.argv[1] if len(sys.argv) > 1 else 'GameboyCPUTests/v2/'
+    for name in sorted(os.listdir(tests_dir)):
+        if name.endswith(".json"):
+            cases, ram, names = load(os.path.join(tests_dir, name))
+            print(name, len(cases), "cases")